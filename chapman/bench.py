@@ -0,0 +1,425 @@
+"""Usage:
+        chapman-bench reserve [options]
+        chapman-bench throughput [options]
+
+"reserve" times message reservation as the backlog grows. It uses its own
+queues and removes its messages when it is done.
+
+"throughput" runs each workload to completion through chapmand's Worker
+(dispatcher, worker threads, WSGI or --direct dispatch and pub/sub
+wakeups), in-process, and reports tasks/sec, the p50/p99 time from a
+message being reserved to it being retired (and, separately, from it
+becoming ready to it being retired, which includes the time it waited in
+the queue), and database operations per task. It needs a real mongod for the event channel (run chapman-init on
+it first). Its tasks use the default 'chapman' queue, so point it at a
+scratch database.
+
+Options:
+  -h --help                 show this help message and exit
+  -u --uri URI              database to use, or "mim" for the in-memory
+                            stand-in used by the tests [default: mim]
+  -b --backlog SIZES        comma-separated backlog sizes to measure
+                            (e.g. 1000,10000,100000,1000000,10000000)
+                            [default: 1000,10000,100000]
+  -n --samples N            reservations to time at each size [default: 200]
+  -w --workload NAMES       comma-separated workloads to run
+                            [default: function,group,pipeline,chain,semaphore]
+  -t --tasks N              function calls per workload [default: 1000]
+  -c --concurrency N        worker threads [default: 10]
+  --direct                  call tasks directly rather than through the app
+  -j --json                 print the results as JSON
+"""
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from datetime import datetime
+
+import ming
+from docopt import docopt
+from pyramid.config import Configurator
+
+from chapman import model as M
+from chapman.stats import stats
+from chapman.task import Function, Group, Pipeline, Chain
+from chapman.worker import Worker
+
+log = logging.getLogger(__name__)
+
+CHAPMAN_PATH = '/__chapman__'
+
+
+def bind(uri):
+    '''Bind the chapman session to uri (or to mim)'''
+    if uri == 'mim':
+        from mongotools import mim
+        M.doc_session.bind = ming.create_datastore(
+            'chapman_bench', bind=ming.create_engine(
+                use_class=lambda *a, **kw: mim.Connection.get()))
+        mim.Connection.get().clear_all()
+    else:
+        M.doc_session.bind = ming.create_datastore(uri)
+    for cls in (M.Message, M.HTTPMessage):
+        M.doc_session.ensure_indexes(cls)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class ReserveBench(object):
+    '''Fills a collection up to each backlog size and times reservation.
+
+    Each timed reservation is undone before the next one, so the backlog
+    stays the same size while it is measured.
+    '''
+    cls = None
+    qname = None
+    sort = None
+    chunk_size = 1000
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.size = 0
+
+    def run(self, backlogs):
+        try:
+            for result in self._run(backlogs):
+                yield result
+        finally:
+            self.cleanup()
+
+    def spec(self):
+        return {
+            's.q': {'$in': [self.qname]},
+            's.status': 'ready',
+            's.after': {'$lte': datetime.utcnow()}}
+
+    def cleanup(self):
+        self.cls.m.remove({'s.q': self.qname})
+
+    def _run(self, backlogs):
+        for backlog in backlogs:
+            self.fill(backlog)
+            times = []
+            for x in xrange(self.samples):
+                start = time.time()
+                msg = self.reserve()
+                times.append(time.time() - start)
+                self.undo(msg)
+            yield dict(
+                collection=self.cls.m.collection.name,
+                backlog=backlog,
+                p50_ms=percentile(times, 50) * 1e3,
+                p99_ms=percentile(times, 99) * 1e3,
+                **self.explain())
+
+    def fill(self, backlog):
+        coll = self.cls.m.collection
+        while self.size < backlog:
+            n = min(self.chunk_size, backlog - self.size)
+            coll.insert([self.make_doc() for x in xrange(n)])
+            self.size += n
+
+    def explain(self):
+        '''Keys and documents examined by the reservation query'''
+        try:
+            plan = self.cls.m.collection.find(self.spec()).sort(
+                self.sort).limit(1).explain()
+        except Exception:  # e.g. mim doesn't explain
+            return dict(keys_examined=None, docs_examined=None)
+        stats = plan.get('executionStats', plan)
+        return dict(
+            keys_examined=stats.get(
+                'totalKeysExamined', stats.get('nscannedAllPlans')),
+            docs_examined=stats.get(
+                'totalDocsExamined', stats.get('nscannedObjectsAllPlans')))
+
+
+class MessageReserveBench(ReserveBench):
+    cls = M.Message
+    qname = 'chapman.bench'
+    sort = M.Message._reserve_sort
+
+    def __init__(self, samples):
+        super(MessageReserveBench, self).__init__(samples)
+        # All the messages are for a single task; its lock is released
+        # after each reservation
+        state = M.TaskState.make(dict(type='bench'))
+        state.m.insert()
+        self.task_id = state._id
+        self.args = M.dumps(())
+        self.kwargs = M.dumps({})
+
+    def make_doc(self):
+        return M.Message.make(dict(
+            task_id=self.task_id,
+            slot='run',
+            args=self.args,
+            kwargs=self.kwargs,
+            s=dict(
+                status='ready', q=self.qname, pri=random.randint(1, 20))))
+
+    def reserve(self):
+        msg, state = M.Message.reserve('bench', [self.qname])
+        return msg
+
+    def undo(self, msg):
+        msg.unlock()
+
+    def cleanup(self):
+        super(MessageReserveBench, self).cleanup()
+        M.TaskState.m.remove({'_id': self.task_id})
+
+
+class HTTPReserveBench(ReserveBench):
+    cls = M.HTTPMessage
+    qname = 'chapman.http.bench'
+    sort = M.HTTPMessage._reserve_sort
+
+    def make_doc(self):
+        return M.HTTPMessage.make(dict(s=dict(
+            after=datetime.utcnow(), q=self.qname,
+            pri=random.randint(1, 20))))
+
+    def reserve(self):
+        return M.HTTPMessage.reserve('bench', [self.qname])
+
+    def undo(self, msg):
+        M.HTTPMessage.m.update_partial(
+            {'_id': msg._id}, {'$set': {'s.status': 'ready'}})
+
+
+def bench_reserve(backlogs, samples):
+    results = []
+    for Bench in (MessageReserveBench, HTTPReserveBench):
+        for result in Bench(samples).run(backlogs):
+            log.info(
+                '%(collection)s: backlog %(backlog)d: '
+                'p50 %(p50_ms).2fms p99 %(p99_ms).2fms '
+                '(examined %(keys_examined)s keys %(docs_examined)s docs)',
+                result)
+            results.append(result)
+    return results
+
+
+@Function.decorate('chapman.bench.noop')
+def noop(x):
+    return x
+
+
+@Function.decorate('chapman.bench.incr')
+def incr(x):
+    return x + 1
+
+
+@Function.decorate('chapman.bench.countdown')
+def countdown(n):
+    if n > 1:
+        raise Chain.call(countdown.n(), n - 1)
+    return n
+
+
+@Function.decorate('chapman.bench.limited', semaphores=['chapman.bench'])
+def limited(x):
+    return x
+
+
+def start_function(n):
+    tasks = [noop.n(i) for i in xrange(n)]
+    for t in tasks:
+        t.start()
+    return tasks
+
+
+def start_group(n, size=10):
+    tasks = [
+        Group.bulk(noop, [(x,) for x in xrange(i, min(n, i + size))])
+        for i in xrange(0, n, size)]
+    for t in tasks:
+        t.start()
+    return tasks
+
+
+def start_pipeline(n, length=5):
+    tasks = []
+    for i in xrange(0, n, length):
+        t = Pipeline.n(*[incr.n() for x in xrange(min(length, n - i))])
+        t.start(i)
+        tasks.append(t)
+    return tasks
+
+
+def start_chain(n, depth=10):
+    tasks = []
+    for i in xrange(0, n, depth):
+        t = countdown.n()
+        t.start(min(depth, n - i))
+        tasks.append(t)
+    return tasks
+
+
+def start_semaphore(n, value=4):
+    M.Semaphore.ensure('chapman.bench', value)
+    tasks = [limited.n(i) for i in xrange(n)]
+    for t in tasks:
+        t.start()
+    return tasks
+
+
+workloads = dict(
+    function=start_function,
+    group=start_group,
+    pipeline=start_pipeline,
+    chain=start_chain,
+    semaphore=start_semaphore)
+
+
+def op_count():
+    '''Operations the server has handled (None if it won't tell us)'''
+    try:
+        counters = M.doc_session.db.command('serverStatus')['opcounters']
+    except Exception:  # e.g. mim
+        return None
+    return sum(counters.values())
+
+
+def make_app():
+    '''A pyramid app routing /__chapman__ to chapmand's view, as the apps
+    hosting chapman do'''
+    config = Configurator()
+    config.add_route('__chapman__', CHAPMAN_PATH)
+    config.add_view(
+        'chapman.chapmand.handle_task',
+        route_name='__chapman__',
+        request_method='CHAPMAN')
+    return config.make_wsgi_app(), config.registry
+
+
+class LatencySink(object):
+    '''Collects the reserve-to-retire ('handle') and ready-to-retire
+    ('total') time of every message run'''
+    metrics = ('handle', 'total')
+
+    def __init__(self):
+        self.latencies = dict((metric, []) for metric in self.metrics)
+
+    def record(self, metric, queue, task_type, seconds):
+        if metric in self.latencies:
+            self.latencies[metric].append(seconds)
+
+    def clear(self):
+        for latencies in self.latencies.values():
+            del latencies[:]
+
+
+class WorkerRunner(object):
+    '''Runs chapmand's Worker (dispatcher, worker threads, scheduler and
+    event loop) in this process'''
+
+    def __init__(self, concurrency, direct):
+        app, registry = make_app()
+        self.name = 'chapman-bench'
+        self.worker = Worker(
+            app=app, name=self.name, qnames=['chapman'],
+            chapman_path=CHAPMAN_PATH, registry=registry,
+            num_threads=concurrency, sleep=0.01, direct=direct)
+        self._thread = threading.Thread(name='events', target=self.worker.run)
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self.worker.start()
+        self._thread.start()
+
+    def stop(self):
+        M.Message.channel.pub('shutdown', self.name)
+        self._thread.join()
+
+
+def wait_for(tasks, poll=0.1):
+    '''Wait until all the tasks have finished'''
+    ids = [t.id for t in tasks]
+    while M.TaskState.m.find({
+            '_id': {'$in': ids},
+            'status': {'$nin': ['success', 'failure']}}).count():
+        time.sleep(poll)
+
+
+def bench_throughput(names, n, concurrency, direct):
+    sink = LatencySink()
+    stats.sinks.append(sink)
+    runner = WorkerRunner(concurrency, direct)
+    runner.start()
+    results = []
+    try:
+        for name in names:
+            sink.clear()
+            ops = op_count()
+            start = time.time()
+            tasks = workloads[name](n)
+            enqueued = time.time()
+            wait_for(tasks)
+            elapsed = time.time() - start
+            if ops is not None:
+                ops = (op_count() - ops) / float(n)
+            handle = list(sink.latencies['handle'])
+            total = list(sink.latencies['total'])
+            result = dict(
+                workload=name,
+                tasks=n,
+                messages=len(handle),
+                enqueue_s=enqueued - start,
+                run_s=elapsed,
+                tasks_per_s=n / elapsed,
+                p50_ms=_ms(percentile(handle, 50)),
+                p99_ms=_ms(percentile(handle, 99)),
+                ready_p50_ms=_ms(percentile(total, 50)),
+                ready_p99_ms=_ms(percentile(total, 99)),
+                ops_per_task=ops)
+            log.info(
+                '%(workload)s: %(tasks)d tasks (%(messages)d messages) '
+                '%(tasks_per_s).1f tasks/s, '
+                'reserve-to-retire p50 %(p50_ms)sms p99 %(p99_ms)sms, '
+                'ready-to-retire p50 %(ready_p50_ms)sms '
+                'p99 %(ready_p99_ms)sms, '
+                '%(ops_per_task)s ops/task',
+                result)
+            results.append(result)
+    finally:
+        runner.stop()
+        stats.sinks.remove(sink)
+    return results
+
+
+def _ms(seconds):
+    '''seconds in ms (None when there were no samples)'''
+    if seconds is None:
+        return None
+    return seconds * 1e3
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    logging.basicConfig(level=logging.INFO)
+    if args['throughput'] and args['--uri'] == 'mim':
+        raise SystemExit('throughput needs a real mongod (use --uri)')
+    bind(args['--uri'])
+    if args['reserve']:
+        backlogs = [int(s) for s in args['--backlog'].split(',')]
+        results = bench_reserve(backlogs, int(args['--samples']))
+    elif args['throughput']:
+        results = bench_throughput(
+            args['--workload'].split(','), int(args['--tasks']),
+            int(args['--concurrency']), bool(args['--direct']))
+    if args['--json']:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
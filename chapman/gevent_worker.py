@@ -0,0 +1,54 @@
+'''Greenlet-based chapmand worker engine.
+
+Each reserved message is handled in its own greenlet from a bounded pool,
+so a single process can keep thousands of I/O-bound tasks in flight. The
+process *must* be monkey-patched before chapman is imported (chapmand
+--engine=gevent does this, see chapman.script.GEVENT_PROLOGUE) so that
+pymongo and the task code yield on I/O, and so that the chapman context `g`
+and pyramid's thread-locals are greenlet-local rather than thread-local.
+'''
+import time
+import logging
+
+import gevent
+import gevent.pool
+
+from chapman import model as M
+from chapman.worker import Worker, _reserve_msgs, exc_log
+
+__all__ = ('GeventWorker',)
+
+log = logging.getLogger(__name__)
+
+
+class GeventWorker(Worker):
+
+    def start(self):
+        M.doc_session.db.collection_names()  # force connection & auth
+        self._pool = gevent.pool.Pool(self._num_threads)
+        self._handler_threads = [
+            gevent.spawn(self.dispatcher),
+            gevent.spawn(self._scheduler.run)]
+
+    def dispatcher(self):
+        log.info('Entering dispatcher greenlet')
+        while not self._shutdown:
+            self._pool.wait_available()
+            count = self._pool.free_count()
+            try:
+                reserved = _reserve_msgs(
+                    self._name, self._qnames, count, self._waitfunc,
+                    self._stats)
+            except StopIteration:
+                break
+            except Exception as err:
+                exc_log.exception(
+                    'Error reserving message: %r, waiting 5s and continuing',
+                    err)
+                time.sleep(5)
+                continue
+            for msg, state in reserved:
+                self._num_active_messages += 1
+                self._pool.spawn(self._handle, msg, state)
+        self._pool.join()
+        log.info('Exiting dispatcher greenlet')
@@ -1,6 +1,6 @@
-import sys
 import json
 import time
+import atexit
 import logging
 import threading
 from Queue import Queue
@@ -8,6 +8,7 @@ from Queue import Queue
 import requests
 
 from . import util
+from .util import sem_multi_acquire, sem_multi_release
 
 log = logging.getLogger(__name__)
 
@@ -36,6 +37,21 @@ class HQueue(object):
             data=json.dumps(msg, default=util.default_json))
         return resp
 
+    def put_many(self, msgs, timeout=300, delay=0, priority=10, tags=None):
+        '''Enqueue several messages in one request; the response is a JSON
+        list of their URLs'''
+        if tags is None:
+            tags = []
+        params = dict(
+            timeout=timeout, delay=delay, priority=priority, batch=1)
+        for i, tag in enumerate(tags):
+            params['tags-%d' % i] = tag
+        resp = self.session.post(
+            self.queue_url,
+            params=params,
+            data=json.dumps(list(msgs), default=util.default_json))
+        return resp
+
     def get(self, client_name, count=1, timeout=30):
         resp = self.session.get(
             self.queue_url,
@@ -48,16 +64,104 @@ class HQueue(object):
     def retry(self, message_id):
         return self.session.post(message_id)
 
+    def retire_many(self, message_ids):
+        '''Retire several messages (by URL) in one request'''
+        return self.session.delete(
+            self.queue_url, data=json.dumps(list(message_ids)))
+
+    def retry_many(self, message_ids, delay=5):
+        '''Retry several messages (by URL) after delay seconds'''
+        return self.session.post(
+            self.queue_url,
+            params=dict(retry=1),
+            data=json.dumps(dict(messages=list(message_ids), delay=delay)))
+
+
+class AckBuffer(object):
+    '''Collects the messages a Listener has handled and retires them in
+    batches, when `size` have been collected or every `interval` seconds.
+
+    The interval flushes happen in a background thread between start() and
+    close() (or within a `with` block); close() retires whatever is left,
+    and is also called at exit.
+    '''
+
+    def __init__(self, hqueue, size=100, interval=1.0):
+        self.hqueue = hqueue
+        self.size = size
+        self.interval = interval
+        self._ids = []
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._stopped = threading.Event()
+        self._timer = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        if self._timer is not None:
+            return
+        self._stopped.clear()
+        self._timer = threading.Thread(name='acks', target=self._run_timer)
+        self._timer.setDaemon(True)
+        self._timer.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self._stopped.set()
+        timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            timer.join()
+        self.flush()
+
+    def _run_timer(self):
+        while not self._stopped.wait(self.interval):
+            self.flush_if_due()
+
+    def add(self, message_id):
+        with self._lock:
+            self._ids.append(message_id)
+            full = len(self._ids) >= self.size
+        if full:
+            self.flush()
+
+    def flush_if_due(self):
+        if time.time() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            ids, self._ids = self._ids, []
+            self._last_flush = time.time()
+        if not ids:
+            return
+        try:
+            resp = self.hqueue.retire_many(ids)
+            if not resp.ok:
+                log.error(
+                    'Error retiring %d messages: %r\n%s',
+                    len(ids), resp, resp.content)
+        except Exception:
+            log.exception('Failed to retire %d messages', len(ids))
+
 
 class Listener(object):
 
-    def __init__(self, hqueue, client_name, n_thread=1, sleep_ms=30000):
+    def __init__(self, hqueue, client_name, n_thread=1, sleep_ms=30000,
+                 ack_size=100, ack_interval=1.0):
         self.hqueue = hqueue
         self.client_name = client_name
         self.n_thread = n_thread
         self.sleep_ms = sleep_ms
+        self.acks = AckBuffer(hqueue, ack_size, ack_interval)
 
     def start(self):
+        self.acks.start()
         sem = threading.Semaphore(self.n_thread)
         q = Queue()
         self._threads = [
@@ -76,39 +180,46 @@ class Listener(object):
             t.start()
 
     def run(self):
-        while True:
-            time.sleep(30)
+        try:
+            while True:
+                time.sleep(self.acks.interval)
+        finally:
+            self.stop()
+
+    def stop(self):
+        '''Retire the messages handled so far'''
+        self.acks.close()
 
     def dispatcher(self, sem, q):
         log.info('Entering dispatcher')
         while True:
-            count = _sem_multi_acquire(sem, self.n_thread)
+            count = sem_multi_acquire(sem, self.n_thread)
             try:
                 try:
                     resp = self.hqueue.get(self.client_name, count=count)
                     log.debug('Got from queue %s', resp)
                 except Exception:
                     log.exception('Could not GET from queue, wait 5s')
-                    _sem_multi_release(sem, count)
+                    sem_multi_release(sem, count)
                     time.sleep(5)
                     continue
                 if not resp.ok:
-                    _sem_multi_release(sem, count)
+                    sem_multi_release(sem, count)
                     log.error(
                         'Error reserving message: %r\n%s',
                         resp, resp.content)
                     continue
                 if resp.status_code == 204:  # no content
-                    _sem_multi_release(sem, count)
+                    sem_multi_release(sem, count)
                     time.sleep(self.sleep_ms / 1000.0)
                     continue
                 try:
                     resp_json = resp.json()
                 except Exception:
-                    _sem_multi_release(sem, count)
+                    sem_multi_release(sem, count)
                     raise
                 # sem.release() for each message requested but NOT received
-                _sem_multi_release(sem, count - len(resp_json))
+                sem_multi_release(sem, count - len(resp_json))
                 for k, v in resp_json.items():
                     log.info('Handle %s', k)
                     try:
@@ -132,34 +243,9 @@ class Listener(object):
             except Exception:
                 log.exception('Error handling request, waiting 5s')
             else:
-                try:
-                    self.hqueue.retire(id)
-                except Exception:
-                    log.exception('Failed to retire %s', id)
+                self.acks.add(id)
             finally:
                 sem.release()
 
     def handle(self, id, msg):
         raise NotImplementedError('handle')
-
-
-def _sem_multi_acquire(sem, max_acquire=sys.maxint):
-    '''sem.acquire() up to max_acquire times, returning the number of
-    times the semaphore was acquired
-    '''
-    count = 0
-    while count < max_acquire and sem.acquire(blocking=0):
-        count += 1
-    if not count:
-        sem.acquire(blocking=1)
-        count = 1
-    return count
-
-
-def _sem_multi_release(sem, count):
-    '''sem.release() the given number of times'''
-    for x in range(count):
-        sem.release()
-
-
-
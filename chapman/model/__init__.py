@@ -1,6 +1,8 @@
-from .m_base import doc_session, loads, dumps
+from .m_base import doc_session, loads, dumps, register_codec, get_codec, Codec
+from .m_base import blobs, configure
 from .m_message import Message
-from .m_task import TaskState
+from .m_task import TaskState, SubtaskResult
 from .m_semaphore import Semaphore
+from .m_counter import Counter, counters
 from .m_http import HTTPMessage
 
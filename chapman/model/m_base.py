@@ -1,7 +1,12 @@
+import struct
+import hashlib
 import logging
 import cPickle as pickle
+from datetime import datetime, timedelta
 
 import bson
+import gridfs
+from bson.binary import BINARY_SUBTYPE
 from pymongo.cursor import _QUERY_OPTIONS
 
 from ming import Session
@@ -12,14 +17,241 @@ doc_session = Session.by_name('chapman')
 log = logging.getLogger(__name__)
 
 
-def dumps(value):
+try:
+    import msgpack
+except ImportError:  # pragma no cover
+    msgpack = None
+
+
+class Codec(object):
+    '''Serializer for task args, kwargs, and results.
+
+    The codec is recorded as the subtype of the bson.Binary it produces, so
+    loads() can always decode a value no matter which codec wrote it.
+    '''
+    name = None
+    subtype = None
+
+    def dumps(self, value):
+        raise NotImplementedError('dumps')
+
+    def loads(self, data):
+        raise NotImplementedError('loads')
+
+
+class PickleCodec(Codec):
+    name = 'pickle'
+    subtype = BINARY_SUBTYPE  # everything written before codecs existed
+
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(Codec):
+    '''Fast, but only handles basic types (sequences decode as lists)'''
+    name = 'msgpack'
+    subtype = 0x80
+
+    def dumps(self, value):
+        if msgpack is None:
+            raise RuntimeError('The msgpack codec requires msgpack')
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class RawCodec(Codec):
+    '''Passes byte strings through untouched. Handles a str, a tuple or
+    list of strs, or a dict of str to str (as args and kwargs need).
+    '''
+    name = 'raw'
+    subtype = 0x81
+
+    def dumps(self, value):
+        if isinstance(value, str):
+            return 's' + value
+        elif isinstance(value, (tuple, list)):
+            return 't' + self._frame(value)
+        elif isinstance(value, dict):
+            return 'd' + self._frame(
+                [x for kv in sorted(value.items()) for x in kv])
+        raise TypeError('Cannot encode %r as raw' % type(value))
+
+    def loads(self, data):
+        kind, data = data[0], str(data[1:])
+        if kind == 's':
+            return data
+        parts = self._unframe(data)
+        if kind == 't':
+            return tuple(parts)
+        return dict(zip(parts[::2], parts[1::2]))
+
+    def _frame(self, parts):
+        chunks = []
+        for part in parts:
+            if not isinstance(part, str):
+                raise TypeError('Cannot encode %r as raw' % type(part))
+            chunks += [struct.pack('>I', len(part)), part]
+        return ''.join(chunks)
+
+    def _unframe(self, data):
+        parts, pos = [], 0
+        while pos < len(data):
+            size, = struct.unpack_from('>I', data, pos)
+            pos += 4
+            parts.append(data[pos:pos + size])
+            pos += size
+        return parts
+
+
+_codecs_by_name = {}
+_codecs_by_subtype = {}
+
+
+def register_codec(codec):
+    _codecs_by_name[codec.name] = codec
+    _codecs_by_subtype[codec.subtype] = codec
+
+
+def get_codec(name=None):
+    '''Look up a codec by name (defaults to pickle)'''
+    if name is None:
+        name = 'pickle'
+    try:
+        return _codecs_by_name[name]
+    except KeyError:
+        raise ValueError('Unknown serializer %r' % (name,))
+
+
+for _codec in (PickleCodec(), MsgpackCodec(), RawCodec()):
+    register_codec(_codec)
+
+
+class BlobStore(object):
+    '''Offloads large encoded values to GridFS.
+
+    Values bigger than threshold bytes are stored in GridFS under their sha1
+    (so shared payloads are only stored once) and replaced in the document
+    by a small reference: the sha1 as a bson.Binary with subtype
+    OFFLOAD_SUBTYPE. The payload is only fetched when the value is decoded.
+    '''
+    OFFLOAD_SUBTYPE = 0x82
+    threshold = None  # set to a size in bytes to enable offloading
+    prefix = 'chapman.blob'
+
+    @property
+    def fs(self):
+        return gridfs.GridFS(doc_session.db, self.prefix)
+
+    @property
+    def files(self):
+        return doc_session.db[self.prefix + '.files']
+
+    @property
+    def chunks(self):
+        return doc_session.db[self.prefix + '.chunks']
+
+    def wrap(self, data, subtype):
+        '''Return data as a Binary, offloading it if it is too big'''
+        if self.threshold is None or len(data) <= self.threshold:
+            return bson.Binary(data, subtype)
+        blob_id = hashlib.sha1(data).hexdigest()
+        # Touch the blob if it already exists so collect() leaves it alone
+        res = self.files.update(
+            {'_id': blob_id}, {'$set': {'ts': datetime.utcnow()}})
+        if not res['updatedExisting']:
+            try:
+                self.fs.put(
+                    data, _id=blob_id, subtype=subtype, ts=datetime.utcnow())
+            except gridfs.errors.FileExists:
+                pass
+        return bson.Binary(blob_id, self.OFFLOAD_SUBTYPE)
+
+    def resolve(self, value):
+        '''Return the stored Binary for an offloaded value (or value)'''
+        if getattr(value, 'subtype', None) != self.OFFLOAD_SUBTYPE:
+            return value
+        f = self.fs.get(str(value))
+        return bson.Binary(f.read(), f.subtype)
+
+    def collect(self, classes, grace=timedelta(hours=1)):
+        '''Delete blobs that no document of the given classes references
+        and that haven't been stored or re-used within grace.
+
+        This scans the _blob_fields of every document, so run it off-peak.
+        '''
+        cutoff = datetime.utcnow() - grace
+        candidates = set(
+            doc['_id'] for doc in self.files.find(
+                {'ts': {'$lt': cutoff}}, fields=['_id']))
+        for cls in classes:
+            if not candidates:
+                break
+            q = cls.m.collection.find({}, fields=cls._blob_fields)
+            for doc in q:
+                candidates.difference_update(self._refs(doc))
+        n = 0
+        for blob_id in candidates:
+            # A wrap() since we picked the candidates touched ts, and the
+            # blob is used again; re-putting a blob after we remove it makes
+            # new chunks, so only remove the ones that were there before
+            chunk_ids = [c['_id'] for c in self.chunks.find(
+                {'files_id': blob_id}, fields=['_id'])]
+            res = self.files.remove({'_id': blob_id, 'ts': {'$lt': cutoff}})
+            if res['n']:
+                self.chunks.remove({'_id': {'$in': chunk_ids}})
+                n += 1
+        return n
+
+    def _refs(self, value):
+        if isinstance(value, dict):
+            for v in value.itervalues():
+                for ref in self._refs(v):
+                    yield ref
+        elif getattr(value, 'subtype', None) == self.OFFLOAD_SUBTYPE:
+            yield str(value)
+
+blobs = BlobStore()
+
+
+def configure(settings, prefix='chapman.'):
+    '''Apply the chapman settings that everything using the model shares:
+    chapmand and the apps that enqueue tasks should all call this (after
+    ming.configure) so they offload payloads the same way.
+
+    - chapman.offload_threshold: offload encoded values bigger than this
+      many bytes to GridFS (see BlobStore)
+    '''
+    threshold = settings.get(prefix + 'offload_threshold')
+    if threshold in (None, ''):
+        blobs.threshold = None
+    else:
+        blobs.threshold = int(threshold)
+
+
+def dumps(value, serializer=None):
     if value is None:
         return value
-    return bson.Binary(pickle.dumps(value))
+    codec = get_codec(serializer)
+    try:
+        data = codec.dumps(value)
+    except (TypeError, ValueError):
+        if codec.name == 'pickle':
+            raise
+        # e.g. a Result sent to a msgpack task; pickle handles anything
+        codec = get_codec()
+        data = codec.dumps(value)
+    return blobs.wrap(data, codec.subtype)
 
 
 def loads(value):
-    return pickle.loads(value)
+    value = blobs.resolve(value)
+    subtype = getattr(value, 'subtype', BINARY_SUBTYPE)
+    return _codecs_by_subtype[subtype].loads(value)
 
 
 class pickle_property(object):
@@ -29,12 +261,41 @@ class pickle_property(object):
     def __get__(self, obj, cls=None):
         if obj is None:
             return self
+        load_lazy(obj)
         return loads(getattr(obj, self._pname))
 
     def __set__(self, obj, value):
+        load_lazy(obj)
         setattr(obj, self._pname, dumps(value))
 
 
+def lazy_projection(cls):
+    '''Projection that leaves cls._lazy_fields out of the loaded documents.
+
+    Documents loaded this way should be passed to mark_lazy() so the
+    missing fields are fetched by load_lazy() when they are needed.
+    '''
+    return dict((name, False) for name in cls._lazy_fields)
+
+
+def mark_lazy(doc):
+    if doc is not None:
+        doc._lazy_pending = True
+    return doc
+
+
+def load_lazy(doc):
+    '''Fetch the fields left out of a doc by lazy_projection()'''
+    if not getattr(doc, '_lazy_pending', False):
+        return
+    doc._lazy_pending = False
+    cls = doc.__class__
+    raw = cls.m.collection.find_one(
+        {'_id': doc._id}, fields=list(cls._lazy_fields))
+    for name in cls._lazy_fields:
+        doc[name] = (raw or {}).get(name)
+
+
 class ChannelProxy(object):
 
     def __init__(self, name, session=None):
@@ -83,6 +344,19 @@ class Resource(object):
         else:
             return False
 
+    def acquire_uncontended(self, msg_id, fields=None):
+        '''Try to acquire the resource for msg_id in a single round trip.
+
+        Succeeds only if no other message holds or is waiting for the
+        resource, returning the updated document (limited to fields, if
+        given). Otherwise returns None and the message is NOT enqueued.
+        '''
+        return self.cls.m.find_and_modify(
+            {'_id': self.id, 'active': {'$size': 0}, 'queued': {'$size': 0}},
+            update={'$set': {'active': [msg_id]}},
+            fields=fields,
+            new=True)
+
     def release(self, msg_id, size):
         '''Release the resource for msg_id.
         Yields a sequence of message ids that should be awakened.
@@ -0,0 +1,115 @@
+import time
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from ming import Field
+from ming.declarative import Document
+
+from .m_base import doc_session
+
+log = logging.getLogger(__name__)
+
+
+class Counter(Document):
+    '''The number of messages in each status for one queue of a collection.
+
+    Kept up to date by the state transitions themselves (through the
+    CounterBuffer below), so reading them costs the same however large the
+    backlog is.
+    '''
+
+    class __mongometa__:
+        name = 'chapman.counter'
+        session = doc_session
+        indexes = [
+            [('c', 1), ('q', 1)],
+        ]
+
+    _id = Field(str)
+    c = Field(str)          # collection counted
+    q = Field(str)
+    n = Field({str: int})   # status => count
+
+    @classmethod
+    def read(cls, collection):
+        '''Return {queue: {status: count}} for a collection'''
+        return dict(
+            (doc.q, dict(doc.n))
+            for doc in cls.m.find({'c': collection}))
+
+
+class CounterBuffer(object):
+    '''Collects counter changes in memory and writes them (as one $inc per
+    queue) at most every `interval` seconds, so counting doesn't add a
+    write to every transition.
+    '''
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._deltas = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def move(self, collection, q, old, new, n=1):
+        '''Record that n messages went from status old to new (either of
+        which may be None, for inserts and deletes)'''
+        if old == new:
+            return
+        with self._lock:
+            deltas = self._deltas[collection, q]
+            if old is not None:
+                deltas[old] -= n
+            if new is not None:
+                deltas[new] += n
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        '''Flush if it has been interval seconds since the last flush.
+        Called on every move() and, so counts don't go stale while the
+        process is idle, periodically by the DelayScheduler.'''
+        if time.time() - self._last_flush < self.interval:
+            return
+        try:
+            self.flush()
+        except Exception:
+            # Counting must never break a state transition
+            log.exception('Could not save message counters')
+
+    def flush(self):
+        '''Write the pending changes. If a write fails, the changes not yet
+        written are kept for the next flush.'''
+        with self._lock:
+            pending, self._deltas = self._deltas, defaultdict(
+                lambda: defaultdict(int))
+            self._last_flush = time.time()
+        pending = pending.items()
+        try:
+            while pending:
+                (collection, q), deltas = pending[0]
+                inc = dict(
+                    ('n.' + status, n) for status, n in deltas.items() if n)
+                if inc:
+                    Counter.m.update_partial(
+                        {'_id': '%s/%s' % (collection, q)},
+                        {'$set': {'c': collection, 'q': q}, '$inc': inc},
+                        upsert=True)
+                pending.pop(0)
+        except Exception:
+            with self._lock:
+                for key, deltas in pending:
+                    for status, n in deltas.items():
+                        self._deltas[key][status] += n
+            raise
+
+
+counters = CounterBuffer()
+
+
+@atexit.register
+def _flush_counters():
+    try:
+        counters.flush()
+    except Exception:
+        log.exception('Could not save message counters')
@@ -1,5 +1,6 @@
 import json
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
 from random import getrandbits
 
@@ -19,14 +20,21 @@ log = logging.getLogger(__name__)
 class HTTPMessage(Document):
     missing_client = '-' * 50
     channel = ChannelProxy('chapman.event')
+    _reserve_sort = [('s.pri', -1), ('s.ts_enqueue', 1)]
+    promote_batch = 1000  # delayed messages to promote per update
 
     class __mongometa__:
         name = 'chapman.http_message'
         session = doc_session
         indexes = [
-            [('s.status', 1), ('s.pri', -1), ('s.ts_enqueue', 1), ('s.q', 1)],
-            [('s.q', 1), ('s.status', 1), ('s.pri', -1), ('s.ts_enqueue', 1)],
-            [('tags', 1)]
+            # Reservation (see Message); s.timeout and _id are the fields
+            # _reserve_many's candidate query returns, so it is covered
+            [('s.status', 1), ('s.q', 1),
+             ('s.pri', -1), ('s.ts_enqueue', 1), ('s.after', 1),
+             ('s.timeout', 1), ('_id', 1)],
+            [('tags', 1)],
+            # DelayScheduler
+            [('s.status', 1), ('s.after', 1)],
         ]
 
     _id = Field(int, if_missing=lambda: getrandbits(63))
@@ -41,7 +49,8 @@ class HTTPMessage(Document):
         after=S.DateTime(if_missing=datetime.fromtimestamp(0)),
         q=S.String(if_missing='chapman.http'),
         pri=S.Int(if_missing=10),
-        cli=S.String(if_missing=missing_client)))
+        cli=S.String(if_missing=missing_client),
+        tok=S.ObjectId(if_missing=None)))  # see _reserve_many
 
     def __json__(self, request):
         return {self.url(request): self.data}
@@ -71,20 +80,129 @@ class HTTPMessage(Document):
             data=_data,
             tags=tags,
             s=dict(timeout=timeout, after=after, q=q, pri=pri)))
+        self.s.status = cls._ready_status(after)
         self.m.insert()
-        self.channel.pub('enqueue', self._id)
+        cls._pub_ready(self._id, self.s.status, after)
         return self
 
+    @classmethod
+    def new_many(cls, datas, timeout=300, after=None, q='chapman.http',
+                 pri=10, tags=None):
+        '''Enqueue a message for each item of datas with a single insert,
+        publishing a single event for all of them'''
+        if tags is None:
+            tags = []
+        if after is None:
+            after = datetime.utcnow()
+        status = cls._ready_status(after)
+        msgs = [
+            cls.make(dict(
+                data=bson.Binary(json.dumps(data, default=util.default_json)),
+                tags=tags,
+                s=dict(
+                    status=status, timeout=timeout, after=after, q=q,
+                    pri=pri)))
+            for data in datas]
+        if not msgs:
+            return msgs
+        cls.m.collection.insert(msgs)
+        if status == 'delayed':
+            cls._pub_ready(None, status, after)
+        else:
+            cls.channel.pub('enqueue', {'q': q, 'n': len(msgs)})
+        return msgs
+
+    @classmethod
+    def retry(cls, msg_id, after):
+        '''Unlock a message so it is retried at after'''
+        cls.retry_many([msg_id], after)
+
+    @classmethod
+    def retry_many(cls, msg_ids, after, q=None):
+        '''Unlock messages (only those in queue q, if given) so they are
+        retried at after, with one update and one event'''
+        if not msg_ids:
+            return
+        status = cls._ready_status(after)
+        spec = {'_id': {'$in': msg_ids}}
+        if q is not None:
+            spec['s.q'] = q
+        cls.m.update_partial(
+            spec,
+            {'$set': {'s.status': status, 's.after': after}},
+            multi=True)
+        cls._pub_ready(msg_ids[0], status, after)
+
+    @classmethod
+    def retire_many(cls, msg_ids, q=None):
+        '''Delete messages (only those in queue q, if given)'''
+        spec = {'_id': {'$in': msg_ids}}
+        if q is not None:
+            spec['s.q'] = q
+        cls.m.remove(spec)
+
+    @classmethod
+    def next_due(cls):
+        '''The s.after of the earliest delayed message (or None)'''
+        q = cls.m.find({'s.status': 'delayed'}, fields=['s.after'])
+        msg = q.sort('s.after').limit(1).first()
+        return msg and msg.s.after
+
+    @classmethod
+    def promote_due(cls, now=None):
+        '''Make the delayed messages that are due 'ready', promote_batch at
+        a time, publishing one 'enqueue' per queue (like new_many)'''
+        if now is None:
+            now = datetime.utcnow()
+        counts = defaultdict(int)
+        while True:
+            due = cls.m.find(
+                {'s.status': 'delayed', 's.after': {'$lte': now}},
+                fields=['_id', 's.q']).limit(cls.promote_batch).all()
+            if not due:
+                break
+            cls.m.update_partial(
+                {'_id': {'$in': [msg._id for msg in due]},
+                 's.status': 'delayed'},
+                {'$set': {'s.status': 'ready'}},
+                multi=True)
+            for msg in due:
+                counts[msg.s.q] += 1
+            if len(due) < cls.promote_batch:
+                break
+        for q, n in counts.items():
+            cls.channel.pub('enqueue', {'q': q, 'n': n})
+        return sum(counts.values())
+
+    @staticmethod
+    def _ready_status(after):
+        '''Messages that aren't due yet wait for the DelayScheduler'''
+        if after > datetime.utcnow():
+            return 'delayed'
+        return 'ready'
+
+    @classmethod
+    def _pub_ready(cls, msg_id, status, after):
+        if status == 'delayed':
+            cls.channel.pub('delay', {
+                'c': cls.m.collection.name, 'after': after})
+        else:
+            cls.channel.pub('enqueue', msg_id)
+
     @classmethod
     def reserve(cls, cli, queues):
         return cls._reserve(cli, {'$in': queues})
 
+    @classmethod
+    def reserve_many(cls, cli, queues, count):
+        return cls._reserve_many(cli, {'$in': queues}, count)
+
     @classmethod
     def _reserve(cls, cli, qspec):
         now = datetime.utcnow()
         self = cls.m.find_and_modify(
             {'s.status': 'ready', 's.q': qspec, 's.after': {'$lte': now}},
-            sort=[('s.pri', -1), ('s.ts_enqueue', 1)],
+            sort=cls._reserve_sort,
             update={'$set': {
                 's.cli': cli,
                 's.status': 'reserved',
@@ -94,3 +212,50 @@ class HTTPMessage(Document):
             self.m.set({'s.ts_timeout': now + timedelta(seconds=self.s.timeout)})
         return self
 
+    @classmethod
+    def _reserve_many(cls, cli, qspec, count):
+        '''Reserve up to count messages: find the candidates, claim them
+        (one update per distinct timeout), and read back the ones we got.
+        s.ts_timeout is set by the claim itself, so a reserved message always
+        has its timeout.
+
+        Each claim is tagged with its own token (s.tok), so concurrent calls
+        with the same client name never read back each other's messages.
+        Candidates lost to another client are replaced by looking again, so
+        fewer than count messages means there are no more ready ones.
+        '''
+        result = []
+        while len(result) < count:
+            now = datetime.utcnow()
+            want = count - len(result)
+            q = cls.m.find(
+                {'s.status': 'ready', 's.q': qspec, 's.after': {'$lte': now}},
+                fields=['_id', 's.timeout'])
+            candidates = q.sort(cls._reserve_sort).limit(want).all()
+            if not candidates:
+                break
+            tok = bson.ObjectId()
+            by_timeout = defaultdict(list)
+            for msg in candidates:
+                by_timeout[msg.s.timeout].append(msg._id)
+            for timeout, ids in by_timeout.items():
+                update = {
+                    's.cli': cli,
+                    's.tok': tok,
+                    's.status': 'reserved',
+                    's.ts_reserve': now}
+                if timeout:
+                    update['s.ts_timeout'] = now + timedelta(seconds=timeout)
+                cls.m.update_partial(
+                    {'_id': {'$in': ids}, 's.status': 'ready'},
+                    {'$set': update},
+                    multi=True)
+            ids = [msg._id for msg in candidates]
+            claimed = dict(
+                (msg._id, msg) for msg in cls.m.find(
+                    {'_id': {'$in': ids}, 's.tok': tok}))
+            result += [claimed[id] for id in ids if id in claimed]
+            if len(candidates) < want and len(claimed) == len(candidates):
+                break  # we got everything that was ready
+        return result
+
@@ -1,14 +1,17 @@
+import time
 import logging
+from collections import defaultdict
 from datetime import datetime
-from cPickle import loads
 from random import getrandbits
 
 from ming import Field
 from ming.declarative import Document
 from ming import schema as S
 
-from .m_base import doc_session, dumps, ChannelProxy
+from .m_base import doc_session, dumps, loads, ChannelProxy
+from .m_base import lazy_projection, mark_lazy, load_lazy
 from .m_task import TaskState, TaskStateResource
+from .m_counter import counters
 from .m_semaphore import SemaphoreResource
 
 log = logging.getLogger(__name__)
@@ -17,14 +20,31 @@ log = logging.getLogger(__name__)
 class Message(Document):
     missing_worker = '-' * 10
     channel = ChannelProxy('chapman.event')
+    _reserve_sort = [('s.sub_status', -1), ('s.pri', -1), ('s.ts', 1)]
+    _blob_fields = ['args', 'kwargs', 'send_args', 'send_kwargs']
+    promote_batch = 1000  # delayed messages to promote per update
+    # Reservation only loads the scheduling fields; the payload is fetched
+    # when the message is run (see load_payload)
+    _lazy_fields = _blob_fields
+    _lazy_pending = False
+    # decoded args/kwargs (class attrs so ming keeps them out of the doc)
+    _decoded_args = None
+    _decoded_kwargs = None
+    _timings = None
 
     class __mongometa__:
         name = 'chapman.message'
         session = doc_session
         indexes = [
-            [('s.status', 1), ('s.pri', -1), ('s.ts', 1), ('s.q', 1)],
-            [('s.q', 1), ('s.status', 1), ('s.sub_status', -1), ('s.pri', -1), ('s.ts', 1)],
+            # Reservation: equality on status, $in on q (merged in sort
+            # order), then the sort keys, then the s.after filter and _id so
+            # the candidate query in _reserve_many is covered
+            [('s.status', 1), ('s.q', 1),
+             ('s.sub_status', -1), ('s.pri', -1), ('s.ts', 1),
+             ('s.after', 1), ('_id', 1)],
             [('task_id', 1)],
+            # DelayScheduler
+            [('s.status', 1), ('s.after', 1)],
         ]
     _id = Field(int, if_missing=lambda: getrandbits(63))
     task_id = Field(int, if_missing=None)
@@ -62,6 +82,15 @@ class Message(Document):
             args = ()
         if kwargs is None:
             kwargs = {}
+        # Encode the args the way the target task wants them
+        serializer = getattr(task, 'serializer', None)
+        return cls.new_encoded(
+            task, slot, dumps(args, serializer), dumps(kwargs, serializer),
+            after, send)
+
+    @classmethod
+    def new_encoded(cls, task, slot, args, kwargs, after=None, send=False):
+        '''Like new(), but args and kwargs are already encoded by dumps()'''
         self = cls.make(dict(
             task_id=task.id,
             task_repr=repr(task),
@@ -69,17 +98,18 @@ class Message(Document):
             s=task.schedule_options()))
         if after is not None:
             self.s.after = after
-        self.args = args
-        self.kwargs = kwargs
+        self._args = args
+        self._kwargs = kwargs
         if send:
-            self.s.status = 'ready'
+            self.s.status = self._ready_status()
             self.s.ts = datetime.utcnow()
             self.send_args = dumps(())
             self.send_kwargs = dumps({})
             self.m.insert()
-            self.channel.pub('send', self._id)
+            self._pub_ready()
         else:
             self.m.insert()
+        cls._count(self.s.q, None, self.s.status)
         return self
 
     @classmethod
@@ -102,10 +132,47 @@ class Message(Document):
         '''
         return cls._reserve(worker, qspec)
 
+    @classmethod
+    def reserve_many(cls, worker, queues, n):
+        '''Reserve up to n messages & try to lock their task states.
+
+        Returns a list of (msg, task) pairs in reservation order, where task
+        is None if the message was reserved but its resources could not be
+        acquired (just like reserve()). An empty list means there were no
+        ready messages (losing a race for them just retries).
+        '''
+        qspec = {'$in': queues}
+        return cls._reserve_many(worker, qspec, n)
+
     def retire(self):
         '''Retire the message.'''
         self._release_resources()
-        self.m.delete()
+        # The message may already be gone (a composite's remove_subtasks()
+        # removes the message it is retiring), so only count what we removed
+        res = self.m.collection.remove({'_id': self._id})
+        if res['n']:
+            self._count(self.s.q, self.s.status, None)
+        self.mark('retire')
+
+    @classmethod
+    def remove_where(cls, spec):
+        '''Remove the messages matching spec (keeping the counters right)'''
+        gone = cls.m.find(spec, fields=['s.status', 's.q']).all()
+        for msg in gone:
+            res = cls.m.collection.remove({'_id': msg._id})
+            if res['n']:
+                cls._count(msg.s.q, msg.s.status, None)
+
+    def mark(self, event):
+        '''Note when this message reached a point in its lifecycle
+        (reserve, acquire, start, end, retire; see chapman.stats)'''
+        if self._timings is None:
+            self._timings = {}
+        self._timings[event] = time.time()
+
+    @property
+    def timings(self):
+        return self._timings
 
     def unlock(self):
         '''Make a message ready for processing'''
@@ -117,41 +184,133 @@ class Message(Document):
                 's.status': 'ready',
                 's.sub_status': 0,
                 's.w': self.missing_worker}})
-        self.channel.pub('send', self._id)
+        self._count(self.s.q, self.s.status, 'ready')
+        self.s.status = 'ready'
+        self._pub_send()
 
     def send(self, *args, **kwargs):
+        self._decoded_args = self._decoded_kwargs = None
+        old_status = self.s.status
+        self.s.status = self._ready_status()
+        self._count(self.s.q, old_status, self.s.status)
         self.m.set(
-            {'s.status': 'ready',
+            {'s.status': self.s.status,
              's.ts': datetime.utcnow(),
              'send_args': dumps(args),
              'send_kwargs': dumps(kwargs)})
-        self.channel.pub('send', self._id)
+        self._pub_ready()
+
+    @classmethod
+    def next_due(cls):
+        '''The s.after of the earliest delayed message (or None)'''
+        q = cls.m.find({'s.status': 'delayed'}, fields=['s.after'])
+        msg = q.sort('s.after').limit(1).first()
+        return msg and msg.s.after
+
+    @classmethod
+    def promote_due(cls, now=None):
+        '''Make the delayed messages that are due 'ready', promote_batch at
+        a time (so a big backlog doesn't make an $in too large to send).
+
+        Publishes one 'send' per queue with messages promoted, which is
+        enough for its workers to keep reserving until they run out.
+        '''
+        if now is None:
+            now = datetime.utcnow()
+        queues = {}
+        total = 0
+        while True:
+            due = cls.m.find(
+                {'s.status': 'delayed', 's.after': {'$lte': now}},
+                fields=['s.q', 's.pri']).limit(cls.promote_batch).all()
+            if not due:
+                break
+            by_queue = defaultdict(list)
+            for msg in due:
+                by_queue[msg.s.q].append(msg)
+            for q, msgs in by_queue.items():
+                # Another scheduler may have promoted some of them, so only
+                # count what we changed
+                res = cls.m.update_partial(
+                    {'_id': {'$in': [msg._id for msg in msgs]},
+                     's.status': 'delayed'},
+                    {'$set': {'s.status': 'ready'}},
+                    multi=True)
+                if not res['n']:
+                    continue
+                cls._count(q, 'delayed', 'ready', res['n'])
+                total += res['n']
+                best = max(msgs, key=lambda msg: msg.s.pri)
+                if q not in queues or best.s.pri > queues[q].s.pri:
+                    queues[q] = best
+            if len(due) < cls.promote_batch:
+                break
+        for msg in queues.values():
+            msg._pub_send()
+        return total
+
+    def load_payload(self):
+        '''Fetch the encoded args & kwargs if reservation left them out'''
+        load_lazy(self)
+
+    def _ready_status(self):
+        '''Messages that aren't due yet wait for the DelayScheduler'''
+        if self.s.after > datetime.utcnow():
+            return 'delayed'
+        return 'ready'
+
+    def _pub_ready(self):
+        if self.s.status == 'delayed':
+            self.channel.pub('delay', {
+                'c': self.__class__.m.collection.name,
+                'after': self.s.after})
+        else:
+            self._pub_send()
+
+    @classmethod
+    def _count(cls, q, old_status, new_status, n=1):
+        counters.move(cls.m.collection.name, q, old_status, new_status, n)
+
+    def _pub_send(self):
+        '''Tell the workers serving this message's queue it is ready'''
+        self.channel.pub(
+            'send', {'_id': self._id, 'q': self.s.q, 'pri': self.s.pri})
 
     @property
     def args(self):
-        result = []
-        if self._send_args is not None:
-            result += loads(self._send_args)
-        if self._args is not None:
-            result += loads(self._args)
-        return tuple(result)
+        if self._decoded_args is None:
+            load_lazy(self)
+            result = []
+            if self._send_args is not None:
+                result += loads(self._send_args)
+            if self._args is not None:
+                result += loads(self._args)
+            self._decoded_args = tuple(result)
+        return self._decoded_args
 
     @args.setter
     def args(self, value):
+        load_lazy(self)
         self._args = dumps(value)
+        self._decoded_args = None
 
     @property
     def kwargs(self):
-        result = {}
-        if self._kwargs is not None:
-            result.update(loads(self._kwargs))
-        if self._send_kwargs is not None:
-            result.update(loads(self._send_kwargs))
-        return result
+        if self._decoded_kwargs is None:
+            load_lazy(self)
+            result = {}
+            if self._kwargs is not None:
+                result.update(loads(self._kwargs))
+            if self._send_kwargs is not None:
+                result.update(loads(self._send_kwargs))
+            self._decoded_kwargs = result
+        return dict(self._decoded_kwargs)
 
     @kwargs.setter
     def kwargs(self, value):
+        load_lazy(self)
         self._kwargs = dumps(value)
+        self._decoded_kwargs = None
 
     @property
     def resources(self):
@@ -166,13 +325,69 @@ class Message(Document):
         # Begin acquisition of resources
         self = cls.m.find_and_modify(
             {'s.q': qspec, 's.status': 'ready', 's.after': {'$lte': now}},
-            sort=[('s.sub_status', -1), ('s.pri', -1), ('s.ts', 1)],
-            update={'$set': {'s.w': worker, 's.status': 'acquire'}},
+            sort=cls._reserve_sort,
+            update={'$set': {'s.w': worker, 's.status': 'busy'}},
+            fields=lazy_projection(cls),
             new=True)
         if self is None:
             return None, None
+        mark_lazy(self)
+        self._count(self.s.q, 'ready', 'busy')
+        self.mark('reserve')
+        return self, self._acquire_resources()
 
-        # Acquire any resources necessary
+    @classmethod
+    def _reserve_many(cls, worker, qspec, n):
+        '''Reserves up to n messages in a fixed number of round trips.'''
+        while True:
+            now = datetime.utcnow()
+            q = cls.m.find(
+                {'s.q': qspec, 's.status': 'ready', 's.after': {'$lte': now}},
+                fields=['_id'])
+            ids = [doc._id for doc in q.sort(cls._reserve_sort).limit(n)]
+            if not ids:
+                return []
+            # Claim all the candidates that are still ready in a single update
+            cls.m.update_partial(
+                {'_id': {'$in': ids}, 's.status': 'ready'},
+                {'$set': {'s.w': worker, 's.status': 'busy'}},
+                multi=True)
+            claimed = dict(
+                (msg._id, mark_lazy(msg)) for msg in cls.m.find(
+                    {'_id': {'$in': ids}, 's.status': 'busy', 's.w': worker},
+                    fields=lazy_projection(cls)))
+            if claimed:
+                break
+            # Other workers claimed every candidate between our find and our
+            # update. The backlog isn't empty, so look again right away
+            # rather than returning [] and sleeping.
+        result = []
+        for msg_id in ids:  # preserve the reservation sort order
+            self = claimed.get(msg_id)
+            if self is not None:
+                self._count(self.s.q, 'ready', 'busy')
+                self.mark('reserve')
+                result.append((self, self._acquire_resources()))
+        return result
+
+    def _acquire_resources(self):
+        '''Acquire the resources for a newly reserved ('busy') message.
+
+        Returns the TaskState if all the resources were acquired and the
+        message is still 'busy', otherwise None.
+        '''
+        cls = self.__class__
+        if not self.s.semaphores and not self.s.sub_status:
+            # Fast path: the only resource is the task lock, so if nobody
+            # else wants it we can take it (and the task) in one round trip
+            state = TaskStateResource(self.task_id).acquire_uncontended(
+                self._id, fields=lazy_projection(TaskState))
+            if state is not None:
+                self.mark('acquire')
+                return mark_lazy(state)
+        # Fall back to the full acquisition protocol
+        self.m.set({'s.status': 'acquire'})
+        self._count(self.s.q, 'busy', 'acquire')
         for i, resource in enumerate(self.resources):
             if i < self.s.sub_status:  # already acquired
                 continue
@@ -185,34 +400,43 @@ class Message(Document):
                     if res['updatedExisting']:
                         break
                     else:
-                        return self, None
+                        return None
                 res = cls.m.update_partial(
                     {'_id': self._id, 's.event': False},
                     {'$set': {'s.status': 'queued'}})
                 if res['updatedExisting']:
-                    return self, None
+                    self._count(self.s.q, 'acquire', 'queued')
+                    self.s.status = 'queued'
+                    return None
                 # Otherwise, try again to acquire the resource
         res = cls.m.update_partial(
             {'_id': self._id, 's.status': 'acquire'},
             {'$set': {'s.status': 'busy'}})
         if res['updatedExisting']:
-            return self, TaskState.m.get(_id=self.task_id)
+            self._count(self.s.q, 'acquire', 'busy')
+            self.s.status = 'busy'
+            self.mark('acquire')
+            return TaskState.get_for_run(self.task_id)
         else:
-            return self, None
+            return None
 
     @classmethod
     def wake(cls, msg_id):
         '''Wake a message that may be enqueued somewhere else'''
-        res = cls.m.update_partial(
+        fields = ['s.q', 's.pri']
+        self = cls.m.find_and_modify(
             {'_id': msg_id, 's.status': 'acquire'},
-            {'$set': {'s.event': True}})
-        if not res['updatedExisting']:
-            res = cls.m.update_partial(
+            update={'$set': {'s.event': True}},
+            fields=fields)
+        if self is None:
+            self = cls.m.find_and_modify(
                 {'_id': msg_id, 's.status': 'queued'},
-                {'$set': {'s.status': 'ready'}})
-            if not res['updatedExisting']:
+                update={'$set': {'s.status': 'ready'}},
+                fields=fields)
+            if self is None:
                 return
-        cls.channel.pub('send', msg_id)
+            cls._count(self.s.q, 'queued', 'ready')
+        self._pub_send()
 
     def _release_resources(self):
         msg_id = None
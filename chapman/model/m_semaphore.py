@@ -1,14 +1,46 @@
+import time
 import logging
 
 from ming import Field
 from ming.declarative import Document
 
-from .m_base import doc_session, Resource
+from .m_base import doc_session, Resource, ChannelProxy
 
 log = logging.getLogger(__name__)
 
 
+class SemaphoreCache(object):
+    '''Per-process cache of semaphore values.
+
+    Entries expire after ttl seconds; workers also update them immediately
+    when a 'semaphore' event is published by Semaphore.resize.
+    '''
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._values = {}
+
+    def get(self, sem_id):
+        entry = self._values.get(sem_id)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        value = Semaphore.m.get(_id=sem_id).value
+        self.set(sem_id, value)
+        return value
+
+    def set(self, sem_id, value):
+        self._values[sem_id] = (value, time.time() + self.ttl)
+
+    def invalidate(self, sem_id=None):
+        if sem_id is None:
+            self._values.clear()
+        else:
+            self._values.pop(sem_id, None)
+
+
 class Semaphore(Document):
+    channel = ChannelProxy('chapman.event')
+    cache = SemaphoreCache()
 
     class __mongometa__:
         name = 'chapman.semaphore'
@@ -21,7 +53,7 @@ class Semaphore(Document):
 
     @classmethod
     def ensure(cls, sem_id, value=5):
-        return cls.m.find_and_modify(
+        sem = cls.m.find_and_modify(
             {'_id': sem_id},
             update={'$setOnInsert': {
                 'value': value,
@@ -29,6 +61,31 @@ class Semaphore(Document):
                 'queued': []}},
             upsert=True,
             new=1)
+        cls.cache.set(sem_id, sem.value)
+        return sem
+
+    @classmethod
+    def resize(cls, sem_id, value):
+        '''Change the value of a semaphore and notify all the workers.
+
+        If the semaphore grew, enough queued messages are awakened to fill
+        the new slots.
+        '''
+        from .m_message import Message
+        sem = cls.m.find_and_modify(
+            {'_id': sem_id},
+            update={'$set': {'value': value}},
+            new=True)
+        cls.cache.set(sem_id, value)
+        cls.channel.pub('semaphore', {'_id': sem_id, 'value': value})
+        to_wake = sem.queued[:max(0, value - len(sem.active))]
+        if to_wake:
+            cls.m.update_partial(
+                {'_id': sem_id},
+                {'$pullAll': {'queued': to_wake}})
+            for msg_id in to_wake:
+                Message.wake(msg_id)
+        return sem
 
 
 class SemaphoreResource(Resource):
@@ -48,9 +105,9 @@ class SemaphoreResource(Resource):
             self.id, obj.value, obj.active, obj.queued)
 
     def acquire(self, msg_id):
-        value = Semaphore.m.get(_id=self.id).value
+        value = Semaphore.cache.get(self.id)
         return super(SemaphoreResource, self).acquire(msg_id, value)
 
     def release(self, msg_id):
-        value = Semaphore.m.get(_id=self.id).value
-        return super(SemaphoreResource, self).release(msg_id, value)
+        # The size isn't needed to release, so don't bother looking it up
+        return super(SemaphoreResource, self).release(msg_id, None)
@@ -6,6 +6,7 @@ from ming.declarative import Document
 from ming import schema as S
 
 from .m_base import doc_session, dumps, pickle_property, Resource
+from .m_base import lazy_projection, mark_lazy
 
 log = logging.getLogger(__name__)
 
@@ -16,6 +17,7 @@ class TaskState(Document):
         session = doc_session
         indexes = [
             [('parent_id', 1), ('data.composite_position', 1)],
+            [('status', 1)],
         ]
 
     _id = Field(int, if_missing=lambda: getrandbits(63))
@@ -35,9 +37,19 @@ class TaskState(Document):
     on_complete = Field(int, if_missing=None)
     active = Field([int])     # just one message active
     queued = Field([int])   # any number queued
+    _blob_fields = ['result', 'data']
+    # left out of the states returned by reservation (see get_for_run)
+    _lazy_fields = ['result']
+    _lazy_pending = False
 
     result = pickle_property('_result')
 
+    @classmethod
+    def get_for_run(cls, id):
+        '''Load a task state without its (possibly large) result'''
+        return mark_lazy(cls.m.find(
+            {'_id': id}, fields=lazy_projection(cls)).first())
+
     @classmethod
     def set_result(cls, id, result):
         cls.m.update_partial(
@@ -54,6 +66,50 @@ class TaskState(Document):
             ' '.join(map(str, parts)))
 
 
+class SubtaskResult(Document):
+    '''The result of one subtask of a Group, stored as it completes'''
+
+    class __mongometa__:
+        name = 'chapman.subtask_result'
+        session = doc_session
+        unique_indexes = [
+            [('task_id', 1), ('position', 1)],
+        ]
+
+    _id = Field(S.ObjectId)
+    task_id = Field(int)
+    position = Field(int)
+    status = Field(str)
+    nested = Field(int, if_missing=None)  # group whose rows result uses
+    _result = Field('result', S.Binary)
+    _blob_fields = ['result']
+
+    result = pickle_property('_result')
+
+    @classmethod
+    def save_result(cls, task_id, position, result, nested=None):
+        cls.m.update_partial(
+            {'task_id': task_id, 'position': position},
+            {'$set': {
+                'status': result.status,
+                'nested': nested,
+                'result': dumps(result)}},
+            upsert=True)
+
+    @classmethod
+    def remove_group(cls, task_id):
+        '''Remove a group's sub-results, and those of the groups (or
+        pipelines ending in groups) nested in it'''
+        ids = [task_id]
+        while ids:
+            q = cls.m.find(
+                {'task_id': {'$in': ids}, 'nested': {'$ne': None}},
+                fields=['nested'])
+            nested = [sr.nested for sr in q]
+            cls.m.remove({'task_id': {'$in': ids}})
+            ids = nested
+
+
 class TaskStateResource(Resource):
     cls=TaskState
 
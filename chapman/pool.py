@@ -0,0 +1,74 @@
+'''Process pool for running CPU-bound Function targets.
+
+Reservation and all task state transitions stay in the worker process; only
+the call to the target happens in a pre-forked child. The child receives the
+encoded args exactly as they are stored in the TaskState and Message so
+they are only decoded once, where they are used.
+
+Targets that need the chapman context or the database (e.g. Chain.call)
+should be decorated with in_process=True so they keep running in the worker.
+'''
+import sys
+import multiprocessing
+
+from chapman import exc
+from chapman import model as M
+from chapman.task import Task, Result
+
+__all__ = ('ProcessPool',)
+
+
+class ProcessPool(object):
+
+    def __init__(self, processes):
+        # Fork *before* any worker threads are started
+        self._pool = multiprocessing.Pool(processes)
+
+    def run(self, task, msg):
+        '''Run the task's target for msg in a child process, returning its
+        Result. Raises Suspend if the target suspended the task.
+        '''
+        state = task._state
+        msg.load_payload()
+        # Fetch any offloaded args here; the children don't use the database
+        resolve = M.blobs.resolve
+        status, value = self._pool.apply(_run_target, (
+            state.type, state._id, repr(task),
+            resolve(state.data.args), resolve(state.data.kwargs),
+            state.options.immutable,
+            resolve(msg._send_args), resolve(msg._args),
+            resolve(msg._kwargs), resolve(msg._send_kwargs)))
+        if status == 'suspend':
+            raise exc.Suspend(value)
+        return value
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def _run_target(
+        task_type, task_id, task_repr, data_args, data_kwargs, immutable,
+        send_args, msg_args, msg_kwargs, send_kwargs):
+    '''Runs in the child: returns ('result', Result) or ('suspend', status)'''
+    try:
+        args = tuple(M.loads(data_args))
+        kwargs = M.loads(data_kwargs)
+        if not immutable:
+            prefix = []
+            if send_args is not None:
+                prefix += M.loads(send_args)
+            if msg_args is not None:
+                prefix += M.loads(msg_args)
+            args = tuple(prefix) + args
+            if msg_kwargs is not None:
+                kwargs.update(M.loads(msg_kwargs))
+            if send_kwargs is not None:
+                kwargs.update(M.loads(send_kwargs))
+        target = Task.by_name(task_type).target
+        return 'result', Result.success(task_id, target(*args, **kwargs))
+    except exc.Suspend as s:
+        return 'suspend', s.status
+    except Exception:
+        return 'result', Result.failure(
+            task_id, 'Error in %s' % task_repr, *sys.exc_info())
@@ -0,0 +1,144 @@
+'''Promotes delayed messages to 'ready' when they come due.
+
+A message sent with s.after in the future is stored with status 'delayed',
+so it stays out of the index range the reservation queries scan. Whoever
+delays a message publishes a 'delay' event with its due time; the
+DelayScheduler keeps those times in a heap (rounded to `resolution` seconds,
+so a burst of delays only adds one entry per tick) and promotes the due
+messages, publishing the usual wakeup events, when the earliest tick comes.
+
+The heap is resynchronized from the database every `resync` seconds in case
+an event was missed. Several schedulers may run against the same collection;
+promotion is idempotent.
+
+If given a CounterBuffer, the scheduler also flushes it at least every
+`counters.interval` seconds, so counters don't go stale in an idle process.
+'''
+import time
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+
+__all__ = ('DelayScheduler',)
+
+log = logging.getLogger(__name__)
+
+
+class DelayScheduler(object):
+
+    def __init__(self, cls, resolution=0.1, resync=60, event=None,
+                 counters=None, sleep=None):
+        self.cls = cls
+        self.counters = counters
+        self.resolution = resolution
+        self.resync = resync
+        self._heap = []
+        self._ticks = set()
+        self._lock = threading.Lock()
+        if event is None:
+            event = threading.Event()
+        self._wakeup = event  # gevent.event.Event() when not monkey-patched
+        if sleep is None:
+            sleep = time.sleep
+        self._sleep = sleep  # gevent.sleep when not monkey-patched
+        self._shutdown = False
+
+    def notify(self, event_data):
+        '''Handle the data of a 'delay' event'''
+        if event_data.get('c') != self.cls.m.collection.name:
+            return
+        self.add(event_data['after'])
+
+    def add(self, after):
+        '''Make sure we wake up no later than after'''
+        tick = self._tick(after)
+        with self._lock:
+            if tick in self._ticks:
+                return
+            self._ticks.add(tick)
+            earliest = not self._heap or tick < self._heap[0]
+            heapq.heappush(self._heap, tick)
+        if earliest:
+            self._wakeup.set()
+
+    def sync(self):
+        '''Reload the earliest due time from the database'''
+        after = self.cls.next_due()
+        if after is not None:
+            self.add(after)
+
+    def run_once(self):
+        '''Promote the messages that are due.
+
+        Returns the number of seconds until the next known tick (or None).
+        '''
+        now = datetime.utcnow()
+        due = False
+        with self._lock:
+            while self._heap and self._heap[0] <= now:
+                self._ticks.discard(heapq.heappop(self._heap))
+                due = True
+            next_tick = self._heap[0] if self._heap else None
+        if due:
+            n = self.cls.promote_due(now)
+            log.debug('Promoted %d delayed %s', n, self.cls.__name__)
+        if next_tick is None:
+            return None
+        return max(0, (next_tick - datetime.utcnow()).total_seconds())
+
+    def run(self):
+        log.info('Entering %s delay scheduler', self.cls.__name__)
+        next_sync = 0
+        while not self._shutdown:
+            try:
+                if time.time() >= next_sync:
+                    self.sync()
+                    next_sync = time.time() + self.resync
+                timeout = next_sync - time.time()
+                until_due = self.run_once()
+                if until_due is not None:
+                    timeout = min(timeout, until_due)
+                if self.counters is not None:
+                    self.counters.flush_if_due()
+                    timeout = min(timeout, self.counters.interval)
+            except Exception as err:
+                log.exception(
+                    'Error promoting delayed messages: %r, waiting 5s', err)
+                timeout = 5
+            # An add() between wait() and clear() is still in the heap, so
+            # the next run_once() will account for it
+            self._wakeup.wait(max(timeout, 0))
+            self._wakeup.clear()
+        log.info('Exiting %s delay scheduler', self.cls.__name__)
+
+    def listen(self, sleep=0.2):
+        '''Feed 'delay' events to the scheduler (for processes that don't
+        already have an event loop, like the HTTP queue server)'''
+        chan = self.cls.channel.new_channel()
+
+        @chan.sub('delay')
+        def handle_delay(chan, msg):
+            self.notify(msg['data'])
+
+        while not self._shutdown:
+            start = time.time()
+            chan.handle_ready(await=True)
+            # The tailable cursor normally blocks waiting for events, so only
+            # sleep if it returned early (to avoid spinning)
+            elapsed = time.time() - start
+            if elapsed < sleep:
+                self._sleep(sleep - elapsed)
+
+    def stop(self):
+        self._shutdown = True
+        self._wakeup.set()
+
+    def _tick(self, after):
+        '''Round after up to the scheduler resolution'''
+        ts = (after - _EPOCH).total_seconds()
+        ticks = -(-ts // self.resolution)
+        return _EPOCH + timedelta(seconds=ticks * self.resolution)
+
+
+_EPOCH = datetime(1970, 1, 1)
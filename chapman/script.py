@@ -1,4 +1,5 @@
 import os
+import sys
 import time
 import base64
 import logging.config
@@ -12,11 +13,22 @@ from formencode import variabledecode as fevd
 from formencode import foreach as fef
 
 from chapman import worker
+from chapman import model as M
+from chapman.stats import stats, StatsdSink
 
 CHUNKSIZE = 4096
 
 log = logging.getLogger(__name__)
 
+# Importing chapman (or pyramid) creates thread-locals (the context `g`,
+# pyramid's request/registry stack), so for the gevent engine the process
+# must be monkey-patched before that, not after: chapmand re-runs itself
+# under this prologue.
+GEVENT_PROLOGUE = 'from gevent.monkey import patch_all; patch_all(dns=False)\n'
+GEVENT_MAIN = GEVENT_PROLOGUE + (
+    'from chapman.script import Chapman\n'
+    'Chapman.script()\n')
+
 
 class Chapman(object):
     """Usage:
@@ -25,7 +37,11 @@ class Chapman(object):
     Options:
       -h --help                 show this help message and exit
       -c,--concurrency THREADS  number of threads to run [default: 1]
+      -e,--engine ENGINE        worker engine, 'thread' or 'gevent' [default: thread]
+      -p,--pool POOL            where Function targets run, 'thread' or 'process' [default: thread]
       -d,--debug                drop into a debugger on task errors?
+      --direct                  call tasks directly rather than through the app
+                                (tasks with their own path still use it)
       -n,--name NAME            override the name of the worker
     """
     settings_schema = fes.Schema(
@@ -33,17 +49,33 @@ class Chapman(object):
         name=fev.String(),
         queues=fef.ForEach(if_missing=['chapman']),
         path=fev.String(),
-        sleep_ms=fev.Int())
+        sleep_ms=fev.Int(),
+        offload_threshold=fev.Int(if_missing=None),
+        statsd=fev.String(if_missing=None))
 
-    def __init__(self, name, path, queues, sleep_ms):
+    def __init__(self, name, path, queues, sleep_ms, offload_threshold=None,
+                 statsd=None):
         self.name = '{}-{}'.format(name, base64.urlsafe_b64encode(os.urandom(6)))
         self.path = path
         self.queues = queues
         self.sleep_ms = sleep_ms
+        self.offload_threshold = offload_threshold
+        self.statsd = statsd
 
     @classmethod
     def script(cls):
         args = docopt(cls.__doc__)
+        engine = args['--engine']
+        try:
+            cls.check_options(engine, args['--pool'])
+        except ValueError as err:
+            raise SystemExit(str(err))
+        if engine == 'gevent':
+            from gevent import monkey
+            if not monkey.is_module_patched('threading'):
+                os.execv(
+                    sys.executable,
+                    [sys.executable, '-c', GEVENT_MAIN] + sys.argv[1:])
         config = args['<config>']
         if '#' in config:
             config, section = config.split('#')
@@ -63,19 +95,53 @@ class Chapman(object):
             app_context['app'],
             app_context['registry'],
             int(args['--concurrency']),
-            bool(args['--debug']))
-
-
-    def run(self, app, registry, concurrency, debug):
+            bool(args['--debug']),
+            engine,
+            args['--pool'],
+            bool(args['--direct']))
+
+    @staticmethod
+    def check_options(engine, pool):
+        if engine not in ('thread', 'gevent'):
+            raise ValueError('Unknown engine: {}'.format(engine))
+        if pool not in ('thread', 'process'):
+            raise ValueError('Unknown pool: {}'.format(pool))
+        if engine == 'gevent' and pool == 'process':
+            # multiprocessing isn't safe under a monkey-patched hub
+            raise ValueError('--pool=process requires --engine=thread')
+
+    def run(self, app, registry, concurrency, debug, engine='thread',
+            pool='thread', direct=False):
+        self.check_options(engine, pool)
         name = '{}:{}'.format(self.name, os.getpid())
         log.info('Starting Chapman')
         log.info('    path:        %s', self.path)
         log.info('    name:        %s', name)
         log.info('    queues:      %s', self.queues)
         log.info('    concurrency: %s', concurrency)
+        log.info('    engine:      %s', engine)
+        log.info('    pool:        %s', pool)
+        log.info('    direct:      %s', direct)
         log.info('    debug:       %s', debug)
         log.info('    sleep_ms:    %s', self.sleep_ms)
-        w = worker.Worker(
+        # Offload like the app does, unless our own section says otherwise
+        M.configure(getattr(registry, 'settings', None) or {})
+        if self.offload_threshold is not None:
+            M.blobs.threshold = self.offload_threshold
+        log.info('    offload:     %s', M.blobs.threshold)
+        log.info('    statsd:      %s', self.statsd)
+        if self.statsd:
+            stats.sinks.append(StatsdSink.from_url(self.statsd))
+        if engine == 'gevent':
+            from chapman.gevent_worker import GeventWorker as Worker
+        else:
+            Worker = worker.Worker
+        if pool == 'process':
+            from chapman.pool import ProcessPool
+            process_pool = ProcessPool(concurrency)
+        else:
+            process_pool = None
+        w = Worker(
             app=app,
             name=name,
             qnames=self.queues,
@@ -83,7 +149,9 @@ class Chapman(object):
             registry=registry,
             num_threads=concurrency,
             sleep=self.sleep_ms / 1000.0,
-            raise_errors=debug)
+            raise_errors=debug,
+            pool=process_pool,
+            direct=direct)
         w.start()
         w.run()
 
@@ -119,9 +187,12 @@ def hq_ping():
     listener = PingListener(args['<qname>'], args['<secret>'])
     listener.start()
 
-    while True:
-        listener.ping()
-        time.sleep(1)
+    try:
+        while True:
+            listener.ping()
+            time.sleep(1)
+    finally:
+        listener.stop()
 
 
 def _setup_logging(config_file):
@@ -0,0 +1,152 @@
+'''In-process latency histograms for the message lifecycle.
+
+Each handled message records, per queue and task type:
+
+- queue: from when it became ready (sent or due) until it was reserved
+- lock: from reservation until its resources were acquired
+- run: from the start of Task.handle until the slot method returned
+- handle: from reservation until the message was retired
+- total: from ready until the message was retired
+
+The histograms are reported in chapmand's 'pong' events (see chapman-ping),
+and every sample is also passed on to any sinks, e.g. a StatsdSink.
+'''
+import re
+import socket
+import calendar
+import threading
+from collections import defaultdict
+
+__all__ = ('Histogram', 'Stats', 'StatsdSink', 'stats')
+
+
+class Histogram(object):
+    '''Log-linear histogram of durations, in the style of HdrHistogram.
+
+    Values are counted in microseconds. Bucket widths double every
+    `sub_buckets` buckets, so percentiles are accurate to within about
+    1/sub_buckets of the value however large it is, in constant memory.
+    '''
+    sub_bits = 5
+    sub_buckets = 1 << sub_bits
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        '''The value (in seconds) at or below which pct% of samples fall'''
+        if not self.count:
+            return None
+        threshold = self.count * pct / 100.0
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= threshold:
+                return min(self._highest(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def summary(self):
+        return dict(
+            count=self.count,
+            p50_ms=self.percentile(50) * 1e3,
+            p90_ms=self.percentile(90) * 1e3,
+            p99_ms=self.percentile(99) * 1e3,
+            max_ms=self.max / 1e3)
+
+    def _index(self, value):
+        if value < 2 * self.sub_buckets:
+            return value
+        exp = value.bit_length() - self.sub_bits - 1
+        return exp * self.sub_buckets + (value >> exp)
+
+    def _highest(self, index):
+        '''The highest value counted in the bucket at index'''
+        if index < 2 * self.sub_buckets:
+            return index
+        exp = index // self.sub_buckets - 1
+        mantissa = index - exp * self.sub_buckets
+        return ((mantissa + 1) << exp) - 1
+
+
+class Stats(object):
+    '''Histograms keyed by (metric, queue, task type)'''
+
+    def __init__(self):
+        self.sinks = []
+        self._histograms = defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    def record(self, metric, queue, task_type, seconds):
+        with self._lock:
+            self._histograms[metric, queue, task_type].record(seconds)
+        for sink in self.sinks:
+            sink.record(metric, queue, task_type, seconds)
+
+    def record_message(self, msg, task_type):
+        '''Record the lifecycle of a handled message (see Message.mark)'''
+        ts = msg.timings
+        if not ts or 'reserve' not in ts or 'retire' not in ts:
+            return
+        q = msg.s.q
+        ready = max(_timestamp(msg.s.ts), _timestamp(msg.s.after))
+        self.record('queue', q, task_type, ts['reserve'] - ready)
+        if 'acquire' in ts:
+            self.record('lock', q, task_type, ts['acquire'] - ts['reserve'])
+        if 'start' in ts and 'end' in ts:
+            self.record('run', q, task_type, ts['end'] - ts['start'])
+        self.record('handle', q, task_type, ts['retire'] - ts['reserve'])
+        self.record('total', q, task_type, ts['retire'] - ready)
+
+    def snapshot(self):
+        with self._lock:
+            items = sorted(self._histograms.items())
+            return [
+                dict(h.summary(), metric=metric, q=q, type=task_type)
+                for (metric, q, task_type), h in items]
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+class StatsdSink(object):
+    '''Send each sample as a statsd timer over UDP'''
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='chapman'):
+        self.addr = (host, int(port))
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @classmethod
+    def from_url(cls, url):
+        '''Build a sink from "host:port"'''
+        host, _, port = url.partition(':')
+        return cls(host or '127.0.0.1', port or 8125)
+
+    def record(self, metric, queue, task_type, seconds):
+        name = '.'.join(
+            [self.prefix, metric, _clean(queue), _clean(task_type)])
+        try:
+            self._sock.sendto(
+                '%s:%.3f|ms' % (name, seconds * 1e3), self.addr)
+        except socket.error:
+            pass  # metrics are best-effort
+
+
+def _timestamp(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def _clean(name):
+    return re.sub(r'[^A-Za-z0-9_-]', '_', str(name))
+
+
+stats = Stats()
@@ -12,12 +12,15 @@ log = logging.getLogger(__name__)
 class Barrier(Group):
     '''Just like a group, but doesn't care about the sub-results'''
 
+    def _save_subresult(self, position, result):
+        # We don't keep sub-results, so nothing will refer to a nested
+        # group's rows once remove_subtasks() removes its state
+        group_id = getattr(result, 'group_id', None)
+        if group_id is not None:
+            M.SubtaskResult.remove_group(group_id)
+
     def retire(self):
-        for st in self.subtask_iter():
-            if st.status == 'failure':
-                self._state.m.set({'status': 'fail-child'})
-                return  # group isn't really done
-            elif st.status != 'success':
-                return  # group isn't really done
+        if not self._subtasks_succeeded():
+            return  # group isn't really done
         self.remove_subtasks()
         self.complete(Result.success(self._state._id, None))
@@ -4,6 +4,7 @@ import logging
 from chapman.context import g
 from chapman.meta import RegistryMetaclass
 from chapman.model import TaskState, Message
+from chapman.stats import stats
 from chapman import exc
 
 log = logging.getLogger(__name__)
@@ -12,6 +13,7 @@ log = logging.getLogger(__name__)
 class Task(object):
     __metaclass__ = RegistryMetaclass
     _registry = {}
+    use_wsgi = False  # always dispatch through the WSGI app in chapmand
 
     def __init__(self, state):
         self._state = state
@@ -44,14 +46,19 @@ class Task(object):
 
     @classmethod
     def new(cls, data, status='pending', **options):
+        state = cls.make_state(data, status, **options)
+        state.m.insert()
+        return cls(state)
+
+    @classmethod
+    def make_state(cls, data, status='pending', **options):
+        '''Build (but don't save) the TaskState for a new task'''
         options.setdefault('path', getattr(g, 'path', None))
-        state = TaskState.make(dict(
+        return TaskState.make(dict(
             type=cls.name,
             status=status,
             options=options,
             data=data))
-        state.m.insert()
-        return cls(state)
 
     @classmethod
     def from_state(cls, state):
@@ -96,6 +103,12 @@ class Task(object):
         msg = Message.new(self, 'run', args, kwargs, send=True)
         return msg
 
+    def start_encoded(self, args, kwargs):
+        '''Like start(), but args and kwargs are already encoded by dumps()
+        (so they can be shared by many tasks)'''
+        self._state.m.set(dict(status='active'))
+        return Message.new_encoded(self, 'run', args, kwargs, send=True)
+
     def schedule(self, after, *args, **kwargs):
         '''Send a 'run' message & update state'''
         self._state.m.set(dict(status='pending'))
@@ -129,6 +142,7 @@ class Task(object):
     def handle(self, msg):
         while msg:
             with g.set_context(task=self, message=msg):
+                msg.mark('start')
                 if self._state.status in ('success', 'failure'):
                     log.warning(
                         'Ignoring message to %s task: %r',
@@ -136,7 +150,9 @@ class Task(object):
                 else:
                     method = getattr(self, msg.slot)
                     method(msg)
+                msg.mark('end')
                 msg.retire()
+                stats.record_message(msg, self._state.type)
                 msg = None
 
 
@@ -12,7 +12,7 @@ class Composite(Task):
     @classmethod
     def new(cls, subtasks, **options):
         self = super(Composite, cls).new(
-            dict(n_subtask=0, n_waiting=0),
+            dict(n_subtask=0, n_waiting=0, n_success=0, n_failure=0),
             'pending', **options)
         for st in subtasks:
             self.append(st)
@@ -53,5 +53,5 @@ class Composite(Task):
 
     def remove_subtasks(self):
         '''Removes all subtasks AND messages for this task'''
-        M.Message.m.remove({'task_id': self.id})
+        M.Message.remove_where({'task_id': self.id})
         M.TaskState.m.remove({'parent_id': self.id})
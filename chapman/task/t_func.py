@@ -13,7 +13,10 @@ log = logging.getLogger(__name__)
 class Function(Task):
     target=None
     raise_errors=False
+    in_process=False  # never run the target in the process pool
     options=None
+    pool=None
+    serializer=None  # codec name for args/kwargs, see model.get_codec
 
     @classmethod
     def n(cls, *args, **kwargs):
@@ -32,8 +35,8 @@ class Function(Task):
         else:
             all_options = {}
         all_options.update(options)
-        data = dict(args=M.dumps(args),
-                    kwargs=M.dumps(kwargs))
+        data = dict(args=M.dumps(args, cls.serializer),
+                    kwargs=M.dumps(kwargs, cls.serializer))
         return super(Function, cls).new(data, **all_options)
 
     @classmethod
@@ -46,9 +49,20 @@ class Function(Task):
 
     def run(self, msg):
         try:
-            args, kwargs = self._merge_args(msg)
-            raw = self.target(*args, **kwargs)
-            result = Result.success(self._state._id, raw)
+            if self.pool is not None and not self.in_process:
+                result = self.pool.run(self, msg)
+                if result.status == 'failure':
+                    if self.raise_errors:
+                        result.get()  # raises the child's TaskError
+                    log.error(
+                        'Task failure id:%s type:%s ex_type:%r',
+                        self._state._id,
+                        self._state.type,
+                        result.data.args[0])
+            else:
+                args, kwargs = self._merge_args(msg)
+                raw = self.target(*args, **kwargs)
+                result = Result.success(self._state._id, raw)
             self.complete(result)
         except exc.Suspend, s:
             self._state.m.set(dict(status=s.status))
@@ -79,7 +93,7 @@ class Function(Task):
         the TaskState, possibly prepended (in the case of *args) or overridden
         (in the case of **kwargs) by msg
         '''
-        args = M.loads(self._state.data.args)
+        args = tuple(M.loads(self._state.data.args))
         kwargs = M.loads(self._state.data.kwargs)
         if not self._state.options.immutable:
             args = msg.args + args
@@ -114,6 +128,12 @@ class FunctionTaskWrapper(object):
             options=options)
         if 'raise_errors' in options:
             dct['raise_errors'] = options.pop('raise_errors')
+        if 'in_process' in options:
+            dct['in_process'] = options.pop('in_process')
+        if 'use_wsgi' in options:
+            dct['use_wsgi'] = options.pop('use_wsgi')
+        if 'serializer' in options:
+            dct['serializer'] = M.get_codec(options.pop('serializer')).name
         self._cls = type(class_name, bases, dct)
 
     def __getattr__(self, name):
@@ -1,5 +1,6 @@
 import sys
 import logging
+from itertools import islice
 
 from chapman import model as M
 
@@ -11,15 +12,103 @@ log = logging.getLogger(__name__)
 
 class Group(Composite):
 
+    @classmethod
+    def bulk(cls, func, iterable_of_args, chunk_size=1000, **options):
+        '''Create a group of func.n(*args) for each args in iterable_of_args.
+
+        The subtasks and their completion messages are built in memory and
+        inserted chunk_size at a time, rather than doing several writes for
+        each subtask as append() does.
+        '''
+        self = cls.new([], **options)
+        child_options = dict(func.options or {})
+        child_options.update(ignore_result=False)
+        child_kwargs = M.dumps({}, func.serializer)
+        schedule = self.schedule_options()
+        it = iter(iterable_of_args)
+        position = 0
+        while True:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                break
+            states, msgs = [], []
+            for args in chunk:
+                state = func.make_state(
+                    dict(args=M.dumps(tuple(args), func.serializer),
+                         kwargs=child_kwargs,
+                         composite_position=position),
+                    **child_options)
+                msg = M.Message.make(dict(
+                    task_id=self.id,
+                    task_repr=repr(self),
+                    slot='retire_subtask',
+                    args=M.dumps((position,)),
+                    kwargs=M.dumps({}),
+                    s=dict(schedule, pri=state.options.priority + 1)))
+                state.parent_id = self.id
+                state.on_complete = msg._id
+                states.append(state)
+                msgs.append(msg)
+                position += 1
+            # Insert the messages first so on_complete is never dangling
+            M.Message.m.collection.insert(msgs)
+            M.Message._count(schedule['q'], None, 'pending', len(msgs))
+            M.TaskState.m.collection.insert(states)
+        M.TaskState.m.update_partial(
+            {'_id': self.id},
+            {'$set': {
+                'data.n_subtask': position,
+                'data.n_waiting': position}})
+        self._state.data.n_subtask = position
+        self._state.data.n_waiting = position
+        return self
+
+    @classmethod
+    def new(cls, subtasks, window=None, **options):
+        '''If window is given, at most that many subtasks are started when
+        the group runs, and another is started as each one completes.
+        '''
+        self = super(Group, cls).new(subtasks, **options)
+        if window:
+            self._state.m.set({'data.window': window})
+        return self
+
     def run(self, msg):
         if self._state.data.n_waiting == 0:
             return self.retire()
         else:
             self._state.m.set(dict(status='active'))
+        # Encode the args once (per codec) and share them with every subtask
+        start_args = _StartArgs(msg.args, msg.kwargs)
+        window = self._state.data.get('window')
+        if window:
+            self._state.m.set({
+                'data.start_args': start_args.encode(None),
+                'data.start_kwargs': start_args.encode(None, 'kwargs')})
+            return self._start_subtasks(window, start_args)
         for st_state in self.subtask_iter():
             if st_state.status == 'pending':
                 st = self.from_state(st_state)
-                st.start(*msg.args, **msg.kwargs)
+                st.start_encoded(*start_args.for_task(st))
+
+    def _start_subtasks(self, count, start_args=None):
+        '''Start the next count pending subtasks (windowed groups only)'''
+        data = self._state.data
+        if start_args is None:
+            start_args = _StartArgs.from_encoded(
+                data.start_args, data.start_kwargs)
+        q = M.TaskState.m.find({
+            'parent_id': self.id,
+            'data.composite_position': {'$gte': data.get('next_position', 0)},
+            'status': 'pending'})
+        q = q.sort('data.composite_position').limit(count)
+        position = None
+        for st_state in q:
+            st = self.from_state(st_state)
+            st.start_encoded(*start_args.for_task(st))
+            position = st_state.data.composite_position
+        if position is not None:
+            self._state.m.set({'data.next_position': position + 1})
 
     def retire_subtask(self, msg):
         try:
@@ -29,50 +118,155 @@ class Group(Composite):
                 log.exception(
                     'Wrong number of args in retire_subtask message: %r',
                     msg.args)
-            M.TaskState.m.update_partial(
+            if result.status == 'success':
+                counter = 'data.n_success'
+            else:
+                counter = 'data.n_failure'
+            self._state = M.TaskState.m.find_and_modify(
                 {'_id': self.id},
-                {'$inc': {'data.n_waiting': -1}})
+                update={'$inc': {'data.n_waiting': -1, counter: 1}},
+                new=True)
+            self._save_subresult(position, result)
             if (self._state.options.ignore_result
                     and result.status == 'success'):
                 M.TaskState.m.remove({'_id': result.task_id})
-            self.refresh()
-            if (self._state.data.n_waiting <= 0
-                    and self._state.status == 'active'):
+            if self._state.status != 'active':
+                return
+            if self._state.data.n_waiting <= 0:
                 self.retire()
+            elif self._state.data.get('window'):
+                self._start_subtasks(1)
         except:
             result = Result.failure(
                 self._state._id, 'Error in %r' % self, *sys.exc_info())
             self.complete(result)
 
+    def _save_subresult(self, position, result):
+        # A nested group's result refers to its own rows, which must go
+        # when ours do
+        M.SubtaskResult.save_result(
+            self.id, position, result,
+            nested=getattr(result, 'group_id', None))
+
     def retire(self):
-        results = []
+        if not self._subtasks_succeeded():
+            return  # group isn't really done
+        gr = GroupResult(self.id, self._state.data.n_subtask)
+        self.remove_subtasks()
+        self.complete(gr)
+
+    def _subtasks_succeeded(self):
+        '''Check that every subtask succeeded, marking the group fail-child
+        if one failed'''
+        data = self._state.data
+        if data.get('n_failure'):
+            self._state.m.set({'status': 'fail-child'})
+            return False
+        if data.get('n_success', 0) >= data.n_subtask:
+            return True
+        # Started before subtasks were counted: the ones that finished
+        # before then have neither counts nor sub-results, so check (and
+        # save) them the old way
         for st in self.subtask_iter():
             if st.status == 'failure':
                 self._state.m.set({'status': 'fail-child'})
-                return  # group isn't really done
+                return False
             elif st.status != 'success':
-                return  # group isn't really done
-            results.append(st.result)
-        gr = GroupResult(self.id, results)
-        self.remove_subtasks()
-        self.complete(gr)
+                return False
+            self._save_subresult(st.data.composite_position, st.result)
+        return True
+
+    def forget(self):
+        M.SubtaskResult.remove_group(self.id)
+        super(Group, self).forget()
+
+
+class _StartArgs(object):
+    '''The args a group starts its subtasks with, encoded at most once for
+    each codec the subtasks use (see Function.serializer)'''
+
+    def __init__(self, args, kwargs):
+        self._decoded = dict(args=args, kwargs=kwargs)
+        self._encoded = {}
+
+    @classmethod
+    def from_encoded(cls, args, kwargs):
+        '''From args and kwargs encoded by M.dumps() with the default codec;
+        they are only decoded if a subtask needs another codec'''
+        self = cls(None, None)
+        self._decoded = None
+        self._encoded[M.get_codec().name] = dict(args=args, kwargs=kwargs)
+        return self
+
+    def for_task(self, task):
+        serializer = getattr(task, 'serializer', None)
+        return self.encode(serializer), self.encode(serializer, 'kwargs')
+
+    def encode(self, serializer, which='args'):
+        name = M.get_codec(serializer).name
+        encoded = self._encoded.get(name)
+        if encoded is None:
+            if self._decoded is None:
+                default = self._encoded[M.get_codec().name]
+                self._decoded = dict(
+                    (k, M.loads(v)) for k, v in default.items())
+            encoded = self._encoded[name] = dict(
+                (k, M.dumps(v, name)) for k, v in self._decoded.items())
+        return encoded[which]
 
 
 class GroupResult(Result):
-    def __init__(self, task_id, sub_results):
-        self.task_id = task_id
-        self.sub_results = sub_results
-        if all(sr.status == 'success'
-               for sr in sub_results):
-            self.status = 'success'
-        else:
-            self.status = 'failure'
+    '''The sub-results live in chapman.subtask_result (saved as each
+    subtask completes) and are only loaded when they are accessed.
+    '''
+
+    def __init__(self, task_id, n_subtask, status='success'):
+        # task_id may be reassigned (e.g. by Pipeline), group_id may not
+        self.task_id = self.group_id = task_id
+        self.n_subtask = n_subtask
+        self.status = status
 
     def __repr__(self):  # pragma no cover
         return '<GroupResult for %s>' % (self.task_id)
 
+    def __len__(self):
+        legacy = self._legacy
+        if legacy is not None:
+            return len(legacy)
+        return self.n_subtask
+
+    def __iter__(self):
+        legacy = self._legacy
+        if legacy is not None:
+            return iter(legacy)
+        q = M.SubtaskResult.m.find({'task_id': self.group_id})
+        return (sr.result for sr in q.sort('position'))
+
     def __getitem__(self, index):
-        return self.sub_results[index]
+        legacy = self._legacy
+        if legacy is not None:
+            return legacy[index]
+        if index < 0:
+            index += self.n_subtask
+        sr = M.SubtaskResult.m.get(task_id=self.group_id, position=index)
+        if sr is None:
+            raise IndexError(index)
+        return sr.result
+
+    @property
+    def _legacy(self):
+        '''The sub-results of a GroupResult pickled before they were stored
+        apart (it has no group_id or n_subtask), otherwise None'''
+        return self.__dict__.get('sub_results')
+
+    @property
+    def sub_results(self):
+        return list(self)
 
     def get(self):
-        return [sr.get() for sr in self.sub_results]
+        return [sr.get() for sr in self]
+
+    def forget(self):
+        if self._legacy is None:
+            M.SubtaskResult.remove_group(self.group_id)
+        super(GroupResult, self).forget()
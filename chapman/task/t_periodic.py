@@ -1,36 +1,72 @@
+import math
 import logging
-from cPickle import dumps
 from datetime import datetime, timedelta
 
-import bson
-
 from chapman import model as M
 
 from .t_base import Task
 from .t_composite import Composite
 
+try:
+    from croniter import croniter
+except ImportError:  # pragma no cover
+    croniter = None
+
 log = logging.getLogger(__name__)
 
 
 class Periodic(Composite):
 
     def __repr__(self):
-        return '<Periodic %s (%s s) %s>' % (
+        return '<Periodic %s (%s) %s>' % (
             self._state._id,
-            self._state.data.interval,
+            self._state.data.get('cron') or
+            '%s s' % self._state.data.interval,
             self._state.data.subtask_repr)
 
     @classmethod
     def schedule(cls, subtask, first, interval, *args, **kwargs):
         '''First is a timestamp, interval is in seconds'''
+        return cls.new_schedule(
+            subtask, first=first, interval=interval,
+            args=args, kwargs=kwargs)
+
+    @classmethod
+    def schedule_cron(cls, subtask, spec, *args, **kwargs):
+        '''Run subtask according to a cron spec (requires croniter)'''
+        return cls.new_schedule(subtask, cron=spec, args=args, kwargs=kwargs)
+
+    @classmethod
+    def new_schedule(
+            cls, subtask, first=None, interval=None, cron=None,
+            coalesce=False, args=(), kwargs=None):
+        '''Run subtask every interval seconds after first, or on a cron spec.
+
+        If the scheduler falls behind (e.g. when no workers are running),
+        the missed runs are skipped, or if coalesce is True replaced by a
+        single run as soon as possible.
+        '''
+        if cron is not None:
+            if croniter is None:
+                raise RuntimeError('cron schedules require croniter')
+            croniter(cron)  # validate the spec
+        elif interval is None:
+            raise ValueError('Either interval or cron must be given')
+        if first is None:
+            first = datetime.utcnow()
+        if kwargs is None:
+            kwargs = {}
+        serializer = getattr(subtask, 'serializer', None)
         t = cls.n()
         t._state.data.update(
             next=first,
             interval=interval,
+            cron=cron,
+            coalesce=coalesce,
             subtask_id=subtask.id,
             subtask_repr=repr(subtask),
-            args=bson.Binary(dumps(args)),
-            kwargs=bson.Binary(dumps(kwargs)))
+            args=M.dumps(args, serializer),
+            kwargs=M.dumps(kwargs, serializer))
         t._state.status = 'active'
         t._state.m.save()
         t._schedule_subtask(subtask)
@@ -38,7 +74,7 @@ class Periodic(Composite):
 
     def cancel(self):
         M.TaskState.m.remove(dict(parent_id=self._state._id))
-        M.Message.m.remove(
+        M.Message.remove_where(
             dict(task_id={'$in': [
                 self._state._id, self._state.data.subtask_id]}))
         self._state.m.delete()
@@ -50,28 +86,46 @@ class Periodic(Composite):
             after=self._state.data.next)
 
     def reschedule_subtask(self, msg=None):
-        msg.m.delete()
         st_state = M.TaskState.m.get(_id=self._state.data.subtask_id)
         st = Task.from_state(st_state)
         self._schedule_subtask(st)
 
+    def next_fire(self, last, now):
+        '''The occurrence to run after last, given it is now now.
+
+        Computed directly rather than by stepping through the missed
+        occurrences, so catching up after downtime is O(1).
+        '''
+        data = self._state.data
+        if data.get('cron'):
+            it = croniter(data.cron, last)
+            next = it.get_next(datetime)
+            if next >= now:
+                return next
+            it = croniter(data.cron, now)
+            if data.get('coalesce'):
+                return it.get_prev(datetime)
+            return it.get_next(datetime)
+        interval = data.interval
+        missed = (now - last).total_seconds() / interval
+        if data.get('coalesce') and missed >= 1:
+            # The latest missed occurrence (in the past, so it runs now)
+            steps = int(missed)
+        else:
+            steps = max(1, int(math.ceil(missed)))
+        return last + timedelta(seconds=steps * interval)
+
     def _schedule_subtask(self, subtask):
-        td_interval = timedelta(seconds=self._state.data.interval)
-        next = self._state.data.next + td_interval
-        while next < datetime.utcnow():
-            next += td_interval
-        subtask.link(self, 'reschedule_subtask')
+        data = self._state.data
+        next = self.next_fire(data.next, datetime.utcnow())
+        link = M.Message.n(self, 'reschedule_subtask')
         self._state.m.set({'data.next': next})
         subtask._state.m.set({
             'parent_id': self.id,
             'status': 'pending',
+            'on_complete': link._id,
             'options.ignore_result': False})
-        msg = M.Message.make(dict(
-            slot='run',
-            task_id=self._state.data.subtask_id,
-            task_repr=self._state.data.subtask_repr,
-            args=self._state.data.args,
-            kwargs=self._state.data.kwargs))
-        msg.s.after = next
-        msg.m.insert()
-        msg.send()
+        # Inserted already 'delayed'; the DelayScheduler promotes it when
+        # it comes due
+        M.Message.new_encoded(
+            subtask, 'run', data.args, data.kwargs, after=next, send=True)
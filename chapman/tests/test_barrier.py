@@ -1,4 +1,4 @@
-from chapman.task import Barrier
+from chapman.task import Barrier, Function, Group
 from chapman import model as M
 
 from .test_base import TaskTest
@@ -16,3 +16,28 @@ class TestBarrier(TaskTest):
         self.assertEqual(M.Message.m.find().count(), 0)
         self.assertEqual(M.TaskState.m.find().count(), 1)
         self.assertEqual(t.result.get(), None)
+
+    def test_child_failure(self):
+        @Function.decorate('barrier_err')
+        def err(x):
+            raise TypeError('Always raises error')
+        t = Barrier.n(
+            self.doubler.n(),
+            err.n())
+        t.start(2)
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(t.status, 'fail-child')
+        self.assertEqual(t._state.data.n_success, 1)
+        self.assertEqual(t._state.data.n_failure, 1)
+
+    def test_nested_group(self):
+        t = Barrier.n(
+            Group.n(self.doubler.n(), self.doubler.n()),
+            self.doubler.n())
+        t.start(2)
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(t.result.get(), None)
+        self.assertEqual(M.TaskState.m.find().count(), 1)
+        self.assertEqual(M.SubtaskResult.m.find().count(), 0)
@@ -1,4 +1,6 @@
-from chapman.task import Function, Group
+from chapman.task import Function, Group, Pipeline
+from chapman.task.t_group import GroupResult
+from chapman.task.t_base import Result
 from chapman import model as M
 from chapman import exc
 from chapman.decorators import task
@@ -18,6 +20,107 @@ class TestGroup(TaskTest):
         self.assertEqual(M.TaskState.m.find().count(), 1)
         self.assertEqual(t.result.get(), [4,4])
 
+    def test_bulk(self):
+        t = Group.bulk(self.doubler, [(x,) for x in range(5)], chunk_size=2)
+        self.assertEqual(t._state.data.n_subtask, 5)
+        self.assertEqual(M.TaskState.m.find().count(), 6)
+        self.assertEqual(M.Message.m.find().count(), 5)
+        t.start()
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(M.Message.m.find().count(), 0)
+        self.assertEqual(M.TaskState.m.find().count(), 1)
+        self.assertEqual(t.result.get(), [0, 2, 4, 6, 8])
+
+    def test_window(self):
+        t = Group.new([self.doubler.n() for x in range(5)], window=2)
+        t.start(3)
+        self._handle_messages(limit=1)  # run the group itself
+        self.assertEqual(
+            M.Message.m.find({'s.status': 'ready'}).count(), 2)
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(M.Message.m.find().count(), 0)
+        self.assertEqual(t.result.get(), [6, 6, 6, 6, 6])
+
+    def test_subtask_serializer(self):
+        @task(serializer='raw')
+        def concat(a, b):
+            return a + b
+        for window in (None, 1):
+            raw = concat.n('x')
+            t = Group.new([raw, self.doubler.n()], window=window)
+            t.start('y')
+            self._handle_messages(limit=1)  # run the group itself
+            msg = M.Message.m.get(task_id=raw.id, slot='run')
+            self.assertEqual(msg._args.subtype, M.get_codec('raw').subtype)
+            self._handle_messages()
+            t.refresh()
+            self.assertEqual(t.result.get(), ['yx', 'yy'])
+
+    def test_lazy_result(self):
+        t = Group.n(
+            self.doubler.n(),
+            self.doubler.n(),
+            self.doubler.n())
+        t.start(2)
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(M.SubtaskResult.m.find().count(), 3)
+        self.assertEqual(len(t.result), 3)
+        self.assertEqual(t.result[-1].get(), 4)
+        self.assertEqual([sr.get() for sr in t.result], [4, 4, 4])
+        t.result.forget()
+        self.assertEqual(M.SubtaskResult.m.find().count(), 0)
+        self.assertEqual(M.TaskState.m.find().count(), 0)
+
+    def test_forget_nested(self):
+        t = Group.n(
+            Group.n(self.doubler.n(), self.doubler.n()),
+            Pipeline.n(
+                self.doubler.n(),
+                Group.n(self.doubler.n(), self.doubler.n())))
+        t.start(2)
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(t.result.get(), [[4, 4], [8, 8]])
+        self.assertEqual(M.SubtaskResult.m.find().count(), 6)
+        t.result.forget()
+        self.assertEqual(M.SubtaskResult.m.find().count(), 0)
+        self.assertEqual(M.TaskState.m.find().count(), 0)
+
+    def test_legacy_result(self):
+        # As pickled before the sub-results were stored apart
+        gr = GroupResult.__new__(GroupResult)
+        gr.__dict__.update(
+            task_id=1, status='success',
+            sub_results=[Result.success(2, 4), Result.success(3, 6)])
+        self.assertEqual(len(gr), 2)
+        self.assertEqual(gr[-1].get(), 6)
+        self.assertEqual(gr.get(), [4, 6])
+        gr.forget()
+
+    def test_uncounted_subtasks(self):
+        # Subtasks that finished before they were counted
+        t = Group.n(self.doubler.n(), self.doubler.n())
+        for st, value in zip(t.subtask_iter(), [2, 4]):
+            M.TaskState.set_result(st._id, Result.success(st._id, value))
+        t.refresh()
+        t.retire()
+        t.refresh()
+        self.assertEqual(t.status, 'success')
+        self.assertEqual(t.result[1].get(), 4)
+        self.assertEqual(t.result.get(), [2, 4])
+
+    def test_uncounted_subtask_failure(self):
+        t = Group.n(self.doubler.n(), self.doubler.n())
+        st = t.subtask_iter().first()
+        M.TaskState.m.update_partial(
+            {'_id': st._id}, {'$set': {'status': 'failure'}})
+        t.retire()
+        t.refresh()
+        self.assertEqual(t.status, 'fail-child')
+
     def test_collect_ignored_results(self):
         t = Group.n(
             self.doubler.new(ignore_result=True),
@@ -0,0 +1,38 @@
+import time
+import unittest
+
+from chapman.hq import AckBuffer
+
+
+class StubHQueue(object):
+
+    def __init__(self):
+        self.retired = []
+
+    def retire_many(self, ids):
+        self.retired.append(list(ids))
+        return type('Response', (), dict(ok=True))()
+
+
+class TestAckBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.hqueue = StubHQueue()
+
+    def test_flush_when_full(self):
+        acks = AckBuffer(self.hqueue, size=2, interval=3600)
+        acks.add('a')
+        self.assertEqual(self.hqueue.retired, [])
+        acks.add('b')
+        self.assertEqual(self.hqueue.retired, [['a', 'b']])
+
+    def test_flush_on_timer(self):
+        with AckBuffer(self.hqueue, interval=0.01) as acks:
+            acks.add('a')
+            time.sleep(0.2)
+            self.assertEqual(self.hqueue.retired, [['a']])
+
+    def test_flush_on_close(self):
+        with AckBuffer(self.hqueue, interval=3600) as acks:
+            acks.add('a')
+        self.assertEqual(self.hqueue.retired, [['a']])
@@ -0,0 +1,153 @@
+import json
+from datetime import datetime, timedelta
+
+from pyramid.request import Request
+
+from chapman import model as M
+from chapman.http import http_main
+
+from .test_base import TaskTest
+
+
+class TestHTTPMessage(TaskTest):
+
+    def test_new_many(self):
+        M.HTTPMessage.new_many([{'a': 1}, {'b': 2}], q='foo')
+        reserved = [M.HTTPMessage.reserve('cli', ['foo']) for x in range(3)]
+        self.assertIsNone(reserved[-1])
+        self.assertEqual(
+            sorted(msg.data for msg in reserved[:2]), [{'a': 1}, {'b': 2}])
+
+    def test_retire_retry_many(self):
+        msgs = M.HTTPMessage.new_many([1, 2, 3], q='foo')
+        for x in range(3):
+            M.HTTPMessage.reserve('cli', ['foo'])
+        M.HTTPMessage.retire_many([msgs[0]._id, msgs[1]._id], 'foo')
+        M.HTTPMessage.retry_many([msgs[2]._id], datetime.utcnow())
+        msg = M.HTTPMessage.reserve('cli', ['foo'])
+        self.assertEqual(msg._id, msgs[2]._id)
+        self.assertEqual(M.HTTPMessage.m.find().count(), 1)
+
+    def test_promote_due(self):
+        after = datetime.utcnow() + timedelta(seconds=60)
+        M.HTTPMessage.new_many([1, 2, 3], q='foo', after=after)
+        M.HTTPMessage.new_many([4, 5], q='bar', after=after)
+        events = []
+
+        class Channel(object):
+            def pub(self, name, data):
+                events.append((name, data))
+
+        M.HTTPMessage.channel, channel = Channel(), M.HTTPMessage.channel
+        promote_batch = M.HTTPMessage.promote_batch
+        M.HTTPMessage.promote_batch = 2
+        try:
+            self.assertEqual(5, M.HTTPMessage.promote_due(after))
+        finally:
+            M.HTTPMessage.channel = channel
+            M.HTTPMessage.promote_batch = promote_batch
+        self.assertEqual(
+            sorted(events),
+            [('enqueue', {'q': 'bar', 'n': 2}),
+             ('enqueue', {'q': 'foo', 'n': 3})])
+        self.assertEqual(
+            5, M.HTTPMessage.m.find({'s.status': 'ready'}).count())
+
+    def test_reserve_many(self):
+        M.HTTPMessage.new(data=1, q='foo', pri=5, timeout=60)
+        M.HTTPMessage.new(data=2, q='foo', pri=1, timeout=60)
+        M.HTTPMessage.new(data=3, q='foo', pri=20, timeout=0)
+        reserved = M.HTTPMessage.reserve_many('cli', ['foo'], 2)
+        self.assertEqual([msg.data for msg in reserved], [3, 1])
+        self.assertEqual(reserved[0].s.ts_timeout, None)
+        self.assertEqual(
+            reserved[1].s.ts_timeout,
+            reserved[1].s.ts_reserve + timedelta(seconds=60))
+        tok = reserved[0].s.tok
+        self.assertIsNotNone(tok)
+        self.assertEqual(reserved[1].s.tok, tok)
+        # Another reservation under the same client name gets its own token
+        reserved = M.HTTPMessage.reserve_many('cli', ['foo'], 10)
+        self.assertEqual([msg.data for msg in reserved], [2])
+        self.assertNotEqual(reserved[0].s.tok, tok)
+        self.assertEqual(M.HTTPMessage.reserve_many('cli', ['foo'], 10), [])
+
+
+class TestHTTPViews(TaskTest):
+
+    def setUp(self):
+        super(TestHTTPViews, self).setUp()
+        self.app = http_main({}, authorization='secret', sleep_ms='50')
+
+    def _request(self, path, method='GET', body=None,
+                 content_type='application/json'):
+        req = Request.blank(
+            path, method=method, headers={'Authorization': 'secret'})
+        if body is not None:
+            req.content_type = content_type
+            req.body = body
+        return req.get_response(self.app)
+
+    def _ids(self, urls):
+        return [int(url.rstrip('/').rsplit('/', 1)[-1]) for url in urls]
+
+    def test_put_many(self):
+        res = self._request(
+            '/1.0/q/foo/?batch=1&priority=5', 'POST', json.dumps([1, 2]))
+        self.assertEqual(res.status_int, 201)
+        ids = self._ids(res.json)
+        msgs = [M.HTTPMessage.m.get(_id=id) for id in ids]
+        self.assertEqual([msg.data for msg in msgs], [1, 2])
+        self.assertEqual([msg.s.q for msg in msgs], ['foo', 'foo'])
+        self.assertEqual([msg.s.pri for msg in msgs], [5, 5])
+
+    def test_put_many_ndjson(self):
+        res = self._request(
+            '/1.0/q/foo/', 'POST', '{"a": 1}\n\n{"b": 2}\n',
+            content_type='application/x-ndjson')
+        self.assertEqual(res.status_int, 201)
+        self.assertEqual(
+            [M.HTTPMessage.m.get(_id=id).data for id in self._ids(res.json)],
+            [{'a': 1}, {'b': 2}])
+
+    def test_put_many_bad_body(self):
+        res = self._request('/1.0/q/foo/?batch=1', 'POST', '{"a": 1}')
+        self.assertEqual(res.status_int, 400)
+        res = self._request(
+            '/1.0/q/foo/', 'POST', '{"a": 1}\nnot json',
+            content_type='application/x-ndjson')
+        self.assertEqual(res.status_int, 400)
+        self.assertEqual(M.HTTPMessage.m.find().count(), 0)
+
+    def test_delete_messages(self):
+        msgs = M.HTTPMessage.new_many([1, 2, 3], q='foo')
+        other = M.HTTPMessage.new(data=4, q='bar')
+        body = json.dumps([
+            'http://localhost/1.0/m/%s/' % msgs[0]._id,
+            str(msgs[1]._id),
+            other._id])
+        res = self._request('/1.0/q/foo/', 'DELETE', body)
+        self.assertEqual(res.status_int, 204)
+        self.assertEqual(
+            sorted(msg._id for msg in M.HTTPMessage.m.find()),
+            sorted([msgs[2]._id, other._id]))
+
+    def test_delete_messages_bad_id(self):
+        res = self._request('/1.0/q/foo/', 'DELETE', json.dumps(['foo/bar']))
+        self.assertEqual(res.status_int, 400)
+
+    def test_retry_messages(self):
+        msg = M.HTTPMessage.new(data=1, q='foo')
+        other = M.HTTPMessage.new(data=2, q='bar')
+        M.HTTPMessage.reserve('cli', ['foo'])
+        M.HTTPMessage.reserve('cli', ['bar'])
+        body = json.dumps({
+            'messages': [
+                'http://localhost/1.0/m/%s/' % msg._id, other._id],
+            'delay': 0})
+        res = self._request('/1.0/q/foo/?retry', 'POST', body)
+        self.assertEqual(res.status_int, 204)
+        self.assertEqual(M.HTTPMessage.m.get(_id=msg._id).s.status, 'ready')
+        # Only messages in the queue posted to are retried
+        self.assertEqual(
+            M.HTTPMessage.m.get(_id=other._id).s.status, 'reserved')
@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+
+from bson.binary import BINARY_SUBTYPE
+
+from chapman import model as M
+from chapman.model import m_counter
+from chapman.task import Group
+
+from .test_base import TaskTest
+
+
+class TestCodecs(TaskTest):
+
+    def test_codecs(self):
+        for name in ('pickle', 'raw'):
+            for value in ('abc', ('a', 'b'), {'a': 'b'}, ()):
+                blob = M.dumps(value, name)
+                self.assertEqual(blob.subtype, M.get_codec(name).subtype)
+                self.assertEqual(M.loads(blob), value)
+
+    def test_codec_fallback(self):
+        blob = M.dumps([1, 2], 'raw')
+        self.assertEqual(blob.subtype, M.get_codec('pickle').subtype)
+        self.assertEqual(M.loads(blob), [1, 2])
+
+
+class TestCounters(TaskTest):
+
+    def test_message_counters(self):
+        M.counters.flush()
+        M.Counter.m.remove({})
+        self.doubler.n().start(2)
+        M.Message.n(self.doubler.n(), 'run', 1)
+        M.counters.flush()
+        self.assertEqual(
+            M.Counter.read('chapman.message'),
+            {'chapman': {'ready': 1, 'pending': 1}})
+        self._handle_messages()
+        M.counters.flush()
+        self.assertEqual(
+            M.Counter.read('chapman.message'),
+            {'chapman': {'ready': 0, 'busy': 0, 'pending': 1}})
+
+    def test_message_counters_group(self):
+        M.counters.flush()
+        M.Counter.m.remove({})
+        t = Group.n(self.doubler.n(), self.doubler.n())
+        t.start(2)
+        self._handle_messages()
+        M.counters.flush()
+        self.assertEqual(M.Message.m.find().count(), 0)
+        counts = M.Counter.read('chapman.message')['chapman']
+        self.assertEqual(
+            dict((k, v) for k, v in counts.items() if v), {})
+
+    def test_counter_flush_failure(self):
+        buf = m_counter.CounterBuffer(interval=3600)
+        buf.move('c', 'q', None, 'ready', 2)
+
+        class Failing(object):
+            class m(object):
+                @staticmethod
+                def update_partial(*args, **kwargs):
+                    raise RuntimeError('database is down')
+
+        m_counter.Counter = Failing
+        try:
+            self.assertRaises(RuntimeError, buf.flush)
+        finally:
+            m_counter.Counter = M.Counter
+        # The changes are still pending, and saved by the next flush
+        buf.flush()
+        self.assertEqual(M.Counter.read('c'), {'q': {'ready': 2}})
+
+    def test_counter_flush_if_due(self):
+        buf = m_counter.CounterBuffer(interval=3600)
+        buf.move('c', 'q', None, 'ready')
+        buf.flush_if_due()
+        self.assertEqual(M.Counter.read('c'), {})
+        buf.interval = 0
+        buf.flush_if_due()
+        self.assertEqual(M.Counter.read('c'), {'q': {'ready': 1}})
+
+
+class TestBlobs(TaskTest):
+
+    def setUp(self):
+        super(TestBlobs, self).setUp()
+        M.blobs.threshold = 100
+
+    def tearDown(self):
+        M.blobs.threshold = None
+
+    def _age_blobs(self):
+        M.blobs.files.update(
+            {}, {'$set': {'ts': datetime.utcnow() - timedelta(hours=2)}},
+            multi=True)
+
+    def test_threshold(self):
+        self.assertEqual(M.dumps('small').subtype, BINARY_SUBTYPE)
+        big = 'x' * 1000
+        ref = M.dumps(big)
+        self.assertEqual(ref.subtype, M.blobs.OFFLOAD_SUBTYPE)
+        self.assertEqual(M.loads(ref), big)
+        # Stored once however many times it is used
+        self.assertEqual(M.dumps(big), ref)
+        self.assertEqual(M.blobs.files.find().count(), 1)
+
+    def test_round_trip(self):
+        big = 'x' * 1000
+        t = self.doubler.n(big)
+        t.start()
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(t.result.get(), big * 2)
+        self.assertEqual(
+            t._state._result.subtype, M.blobs.OFFLOAD_SUBTYPE)
+
+    def test_configure(self):
+        M.configure({'chapman.offload_threshold': '10'})
+        self.assertEqual(M.blobs.threshold, 10)
+        M.configure({})
+        self.assertEqual(M.blobs.threshold, None)
+
+    def test_collect(self):
+        t = self.doubler.n('x' * 1000)
+        M.dumps('y' * 1000)
+        self._age_blobs()
+        classes = [M.Message, M.TaskState, M.SubtaskResult]
+        self.assertEqual(M.blobs.collect(classes), 1)
+        self.assertEqual(M.blobs.files.find().count(), 1)
+        self.assertEqual(M.blobs.chunks.find().count(), 1)
+        t.refresh()
+        self.assertEqual(M.loads(t._state.data.args), ('x' * 1000,))
+
+    def test_collect_keeps_reused_blob(self):
+        data = 'z' * 1000
+        M.dumps(data)
+        self._age_blobs()
+
+        class Collection(object):
+            @staticmethod
+            def find(spec, fields):
+                # Somebody reuses the blob while collect() is scanning
+                M.dumps(data)
+                return []
+
+        class Reuser(object):
+            _blob_fields = []
+            m = type('m', (), dict(collection=Collection))
+
+        self.assertEqual(M.blobs.collect([Reuser]), 0)
+        self.assertEqual(M.loads(M.dumps(data)), data)
@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta
+
+from chapman import model as M
+from chapman.task import Periodic
+
+from .test_base import TaskTest
+
+
+class TestPeriodic(TaskTest):
+
+    def test_next_fire(self):
+        first = datetime(2015, 1, 1)
+        t = Periodic.new_schedule(self.doubler.n(), first=first, interval=60)
+        msg = M.Message.m.get(task_id=t._state.data.subtask_id, slot='run')
+        self.assertEqual(msg.s.status, 'ready')
+        now = first + timedelta(seconds=150)
+        self.assertEqual(
+            t.next_fire(first, now), first + timedelta(seconds=180))
+        self.assertEqual(
+            t.next_fire(first, first), first + timedelta(seconds=60))
+        t._state.data.coalesce = True
+        self.assertEqual(
+            t.next_fire(first, now), first + timedelta(seconds=120))
@@ -16,6 +16,7 @@ class TestSemaphoreTask(TaskTest):
         self.sem0.m.save()
         self.sem1 = M.Semaphore.make(dict(_id='bar', value=2))
         self.sem1.m.save()
+        M.Semaphore.cache.invalidate()
 
     def test_cant_acquire_too_many(self):
         msgs = [M.Message.n(self.echo1.n('hi'), 'run') for i in range(5)]
@@ -70,6 +71,21 @@ class TestSemaphoreTask(TaskTest):
         sem = M.Semaphore.ensure('foo', 5)
         self.assertEqual(sem.value, 5)
 
+    def test_resize_wakes_queued(self):
+        msgs = [M.Message.n(self.echo1.n('hi'), 'run') for i in range(4)]
+        for msg in msgs:
+            msg.send()
+        for x in range(4):
+            M.Message.reserve('foo', ['chapman'])
+        M.Semaphore.resize('foo', 3)
+        self.assertEqual(M.Semaphore.cache.get('foo'), 3)
+        self.assertEqual(M.Semaphore.m.get(_id='foo').value, 3)
+        msg, ts = M.Message.reserve('foo', ['chapman'])
+        self.assertEqual(msg._id, msgs[2]._id)
+        self.assertIsNotNone(ts)
+        msg, ts = M.Message.reserve('foo', ['chapman'])
+        self.assertIsNone(msg)
+
     def test_sem_doesnt_muck_things_up(self):
         runs = []
         @task(raise_errors=True, semaphores=['foo'])
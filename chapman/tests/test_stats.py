@@ -0,0 +1,22 @@
+from chapman.stats import stats, Histogram
+
+from .test_base import TaskTest
+
+
+class TestStats(TaskTest):
+
+    def test_histogram(self):
+        h = Histogram()
+        for ms in range(1, 1001):
+            h.record(ms / 1e3)
+        self.assertAlmostEqual(h.percentile(50), 0.5, delta=0.5 / 32)
+        self.assertAlmostEqual(h.percentile(99), 0.99, delta=0.99 / 32)
+        self.assertEqual(h.percentile(100), 1.0)
+
+    def test_lifecycle_stats(self):
+        stats.reset()
+        self.doubler.n().start(2)
+        self._handle_messages()
+        self.assertEqual(
+            set(h['metric'] for h in stats.snapshot()),
+            set(['queue', 'lock', 'run', 'handle', 'total']))
@@ -1,10 +1,38 @@
+import os
+from datetime import datetime, timedelta
+
 from chapman.task import Task, Function
 from chapman.decorators import task
 from chapman import model as M
 from chapman import exc
+from chapman.pool import ProcessPool
+from chapman.scheduler import DelayScheduler
 
 from .test_base import TaskTest
 
+
+# Pool targets are looked up by name in the children, so they must be
+# defined before the pool forks
+@task('test.pool.pid')
+def pool_pid(x):
+    return x, os.getpid()
+
+
+@task('test.pool.pid_in_process', in_process=True)
+def pool_pid_in_process(x):
+    return x, os.getpid()
+
+
+@task('test.pool.fail')
+def pool_fail():
+    raise ValueError('failed in the pool')
+
+
+@task('test.pool.fail_raise', raise_errors=True)
+def pool_fail_raise():
+    raise ValueError('failed in the pool')
+
+
 class TestBasic(TaskTest):
 
     def test_curry(self):
@@ -44,6 +72,16 @@ class TestBasic(TaskTest):
         self.assertEqual(msg.kwargs, {'a': 3})
         self.assertEqual(1, M.Message.m.find().count())
         
+    def test_message_args_cached(self):
+        t = self.doubler.n()
+        msg = M.Message.n(t, 'run', 1, a=3)
+        self.assertIs(msg.args, msg.args)
+        self.assertNotIn('_decoded_args', msg)
+        msg.send(2)
+        self.assertEqual(msg.args, (2, 1))
+        msg.kwargs = {'b': 4}
+        self.assertEqual(msg.kwargs, {'b': 4})
+
     def test_start(self):
         t = self.doubler.n()
         msg = t.start(2)
@@ -144,3 +182,154 @@ class TestBasic(TaskTest):
         t1.refresh()
 
         self.assertEqual(t1.result.get(), 28)
+
+    def test_reserve_many(self):
+        t0 = self.doubler.new(priority=5)
+        t1 = self.doubler.new(priority=20)
+        t2 = self.doubler.new(priority=10)
+        for t in (t0, t1, t2):
+            t.start(2)
+        reserved = M.Message.reserve_many('foo', ['chapman'], 2)
+        self.assertEqual(
+            [s._id for m, s in reserved], [t1.id, t2.id])
+        for m, s in reserved:
+            self.assertEqual(m.s.status, 'busy')
+            Task.from_state(s).handle(m)
+        reserved = M.Message.reserve_many('foo', ['chapman'], 2)
+        self.assertEqual([s._id for m, s in reserved], [t0.id])
+        self.assertEqual(M.Message.reserve_many('foo', ['chapman'], 2), [])
+
+    def test_reserve_is_lazy(self):
+        t = self.doubler.n()
+        t.start(2)
+        msg, state = M.Message.reserve('foo', ['chapman'])
+        self.assertIsNone(msg._args)
+        self.assertEqual(msg.args, (2,))
+        self.assertIsNotNone(msg._args)
+        Task.from_state(state).handle(msg)
+        t.refresh()
+        self.assertEqual(4, t.result.get())
+
+    def test_delayed_message(self):
+        t = self.doubler.n()
+        after = datetime.utcnow() + timedelta(seconds=60)
+        msg = t.schedule(after, 2)
+        msg = M.Message.m.get(_id=msg._id)
+        self.assertEqual(msg.s.status, 'delayed')
+        self.assertEqual(M.Message.reserve('foo', ['chapman']), (None, None))
+        sched = DelayScheduler(M.Message)
+        sched.sync()
+        self.assertEqual(len(sched._heap), 1)
+        self.assertGreater(sched.run_once(), 0)
+        self.assertEqual(0, M.Message.promote_due())
+        self.assertEqual(1, M.Message.promote_due(after))
+        msg = M.Message.m.get(_id=msg._id)
+        self.assertEqual(msg.s.status, 'ready')
+
+    def test_scheduler_listen_backs_off(self):
+        sleeps = []
+
+        class Channel(object):
+            calls = 0
+
+            def new_channel(self):
+                return self
+
+            def sub(self, name):
+                return lambda func: func
+
+            def handle_ready(self, await=False):
+                # Returns at once, as an exhausted cursor would
+                self.calls += 1
+                if self.calls == 3:
+                    sched.stop()
+
+        class Messages(object):
+            channel = Channel()
+
+        sched = DelayScheduler(Messages, sleep=sleeps.append)
+        sched.listen(sleep=0.5)
+        self.assertEqual(len(sleeps), 3)
+        for s in sleeps:
+            self.assertGreater(s, 0.4)
+
+    def test_promote_due_in_batches(self):
+        after = datetime.utcnow() + timedelta(seconds=60)
+        for x in range(5):
+            self.doubler.n().schedule(after, x)
+        promote_batch, M.Message.promote_batch = M.Message.promote_batch, 2
+        try:
+            self.assertEqual(5, M.Message.promote_due(after))
+        finally:
+            M.Message.promote_batch = promote_batch
+        self.assertEqual(
+            5, M.Message.m.find({'s.status': 'ready'}).count())
+
+    def test_reserve_contended_task(self):
+        t = self.doubler.n()
+        m0 = M.Message.n(t, 'run', 1)
+        m1 = M.Message.n(t, 'run', 2)
+        m0.send()
+        m1.send()
+        m, s = M.Message.reserve('foo', ['chapman'])
+        self.assertEqual(m._id, m0._id)
+        self.assertEqual(m.s.status, 'busy')
+        self.assertEqual(s.active, [m0._id])
+        m, s = M.Message.reserve('foo', ['chapman'])
+        self.assertEqual(m._id, m1._id)
+        self.assertIsNone(s)
+        self.assertEqual(M.Message.m.get(_id=m1._id).s.status, 'queued')
+        m0.retire()
+        m, s = M.Message.reserve('foo', ['chapman'])
+        self.assertEqual(m._id, m1._id)
+        self.assertEqual(s.active, [m1._id])
+
+    def test_raw_serializer(self):
+        @task(serializer='raw')
+        def concat(a, b):
+            return a + b
+        t = concat.n('x')
+        msg = t.start('y')
+        self.assertEqual(msg._args.subtype, M.get_codec('raw').subtype)
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(t.result.get(), 'yx')
+
+
+class TestProcessPool(TaskTest):
+
+    def setUp(self):
+        super(TestProcessPool, self).setUp()
+        self.pool = Function.pool = ProcessPool(1)
+
+    def tearDown(self):
+        Function.pool = None
+        self.pool.close()
+
+    def test_run_in_pool(self):
+        t = pool_pid.n()
+        t.start(2)
+        self._handle_messages()
+        t.refresh()
+        x, pid = t.result.get()
+        self.assertEqual(x, 2)
+        self.assertNotEqual(pid, os.getpid())
+
+    def test_in_process(self):
+        t = pool_pid_in_process.n(1)
+        t.start()
+        self._handle_messages()
+        t.refresh()
+        self.assertEqual(t.result.get(), (1, os.getpid()))
+
+    def test_failure(self):
+        t = pool_fail.n()
+        t.start()
+        self._handle_messages()
+        t.refresh()
+        self.assertRaises(exc.TaskError, t.result.get)
+
+    def test_raise_errors(self):
+        t = pool_fail_raise.n()
+        t.start()
+        self.assertRaises(exc.TaskError, self._handle_messages)
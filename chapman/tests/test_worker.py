@@ -0,0 +1,198 @@
+import sys
+import time
+import unittest
+import subprocess
+
+import gevent.pool
+from pyramid.request import Request
+
+from chapman import model as M
+from chapman.context import g
+from chapman.chapmand import handle_task
+from chapman.decorators import task
+from chapman.script import Chapman, GEVENT_PROLOGUE
+from chapman.worker import Worker
+from chapman.gevent_worker import GeventWorker
+
+from .test_base import TaskTest
+
+
+@task('test.worker.context')
+def context():
+    return g.request.path_info, g.registry
+
+
+@task('test.worker.mark_request')
+def mark_request():
+    seen = getattr(g.request, 'chapman_mark', None)
+    g.request.chapman_mark = True
+    return seen
+
+
+class StubEvent(object):
+    '''Stands in for threading.Event, recording how it is used'''
+
+    def __init__(self, fired=False):
+        self.fired = fired
+        self.calls = []
+
+    def set(self):
+        self.calls.append('set')
+        self.fired = True
+
+    def clear(self):
+        self.calls.append('clear')
+        self.fired = False
+
+    def wait(self, timeout=None):
+        self.calls.append(('wait', timeout))
+        return self.fired
+
+
+class StubChannel(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def handle_ready(self, await=False, raise_errors=False):
+        self.calls += 1
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = Worker(
+            app=None, name='test', qnames=['chapman'], chapman_path='/',
+            registry=None, sleep=0.05)
+        self.event = self.worker._send_event = StubEvent()
+
+    def test_waitfunc_times_out(self):
+        self.assertFalse(self.worker._waitfunc())
+        self.assertEqual(self.event.calls, [('wait', 0.05), 'clear'])
+
+    def test_waitfunc_clears_after_waking(self):
+        self.event.fired = True
+        self.assertTrue(self.worker._waitfunc())
+        # Cleared after the wait, so a 'send' that arrived before it
+        # isn't lost
+        self.assertEqual(self.event.calls, [('wait', 0.05), 'clear'])
+        self.assertFalse(self.event.fired)
+
+    def test_waitfunc_shutdown(self):
+        self.worker._shutdown = True
+        self.assertRaises(StopIteration, self.worker._waitfunc)
+        self.assertEqual(self.event.calls, [])
+
+    def test_handle_events_sleeps_when_early(self):
+        chan = StubChannel()
+        start = time.time()
+        self.worker._handle_events(chan)
+        self.assertEqual(chan.calls, 1)
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def test_send_for_our_queue(self):
+        self.worker._handle_send({'_id': 1, 'q': 'chapman', 'pri': 10})
+        self.assertTrue(self.event.fired)
+        self.assertEqual(self.worker._stats['send_events'], 1)
+        self.assertEqual(self.worker._stats['send_ignored'], 0)
+
+    def test_send_for_other_queue(self):
+        self.worker._handle_send({'_id': 1, 'q': 'other', 'pri': 10})
+        self.assertFalse(self.event.fired)
+        self.assertEqual(self.worker._stats['send_ignored'], 1)
+
+    def test_send_without_queue(self):
+        # Old publishers only sent the message id
+        self.worker._handle_send(1)
+        self.assertTrue(self.event.fired)
+
+    def test_check_options(self):
+        Chapman.check_options('thread', 'process')
+        Chapman.check_options('gevent', 'thread')
+        self.assertRaises(
+            ValueError, Chapman.check_options, 'gevent', 'process')
+        self.assertRaises(
+            ValueError, Chapman.check_options, 'eventlet', 'thread')
+
+
+class TestGeventWorker(TaskTest):
+
+    def test_context_is_greenlet_local(self):
+        # Run in a fresh process, patched the way chapmand patches itself
+        code = GEVENT_PROLOGUE + '''
+import gevent
+from pyramid.threadlocal import manager
+from chapman.context import g
+
+def run(name):
+    with g.set_context(name=name):
+        manager.push(dict(request=name, registry=None))
+        gevent.sleep(0.01)
+        assert g.name == name, (g.name, name)
+        assert manager.get()['request'] == name
+        manager.pop()
+
+gevent.joinall(
+    [gevent.spawn(run, 'a'), gevent.spawn(run, 'b')], raise_error=True)
+'''
+        subprocess.check_call([sys.executable, '-c', code])
+
+    def test_dispatch(self):
+        w = GeventWorker(
+            app=None, name='test', qnames=['chapman'], chapman_path='/',
+            registry=None, num_threads=2, direct=True)
+        w._pool = gevent.pool.Pool(2)
+        tasks = [self.doubler.n(x) for x in range(3)]
+        for t in tasks:
+            t.start()
+
+        def waitfunc():
+            raise StopIteration()
+        w._waitfunc = waitfunc
+        w.dispatcher()  # runs until the queue is empty
+        for x, t in enumerate(tasks):
+            t.refresh()
+            self.assertEqual(x * 2, t.result.get())
+        self.assertEqual(w._num_active_messages, 0)
+
+
+class TestDirect(TaskTest):
+
+    def setUp(self):
+        super(TestDirect, self).setUp()
+        self.paths = []
+        self.worker = Worker(
+            app=self._app, name='test', qnames=['chapman'],
+            chapman_path='/__chapman__', registry='registry', direct=True)
+
+    def _app(self, environ, start_response):
+        # Stands in for a pyramid app routing to chapmand.handle_task
+        request = Request(environ)
+        self.paths.append(request.path_info)
+        handle_task(request)
+        return []
+
+    def _run(self, t):
+        t.start()
+        msg, state = M.Message.reserve('test', ['chapman'])
+        self.worker._handle(msg, state)
+        t.refresh()
+        return t.result.get()
+
+    def test_direct_matches_wsgi(self):
+        direct = self._run(context.n())
+        self.assertEqual(self.paths, [])
+        self.worker._direct = False
+        wsgi = self._run(context.n())
+        self.assertEqual(self.paths, ['/__chapman__'])
+        self.assertEqual(direct, wsgi)
+        self.assertEqual(direct, ('/__chapman__', 'registry'))
+
+    def test_direct_task_with_path(self):
+        result = self._run(context.new(path='/other'))
+        self.assertEqual(self.paths, ['/other'])
+        self.assertEqual(result, ('/other', 'registry'))
+
+    def test_direct_fresh_request(self):
+        self.assertEqual(self._run(mark_request.n()), None)
+        self.assertEqual(self._run(mark_request.n()), None)
@@ -1,3 +1,4 @@
+import sys
 from datetime import datetime
 import bson
 
@@ -17,3 +18,21 @@ def default_json(x):
         return [default_json(v) for v in x]
     return x
 
+
+def sem_multi_acquire(sem, max_acquire=sys.maxint):
+    '''sem.acquire() up to max_acquire times, returning the number of
+    times the semaphore was acquired
+    '''
+    count = 0
+    while count < max_acquire and sem.acquire(blocking=0):
+        count += 1
+    if not count:
+        sem.acquire(blocking=1)
+        count = 1
+    return count
+
+
+def sem_multi_release(sem, count):
+    '''sem.release() the given number of times'''
+    for x in range(count):
+        sem.release()
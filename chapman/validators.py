@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 
+from formencode import Invalid
 from formencode import validators as fev
 from formencode import schema as fes
 from formencode import foreach as fef
@@ -16,6 +17,16 @@ class DateTime(fev.FancyValidator):
         return ts + timedelta(microseconds=us)
 
 
+class MessageId(fev.FancyValidator):
+    '''A message id, or the URL of a message'''
+
+    def _to_python(self, value, state=None):
+        try:
+            return int(unicode(value).rstrip('/').rsplit('/', 1)[-1])
+        except ValueError:
+            raise Invalid('Not a message: %r' % (value,), value, state)
+
+
 message_schema = fes.Schema(
     priority=fev.Int(if_empty=10, if_missing=10),
     delay=fev.Int(if_missing=0),
@@ -29,3 +40,9 @@ get_schema = fes.Schema(
 
 retry_schema = fes.Schema(
     delay=fev.Int(if_empty=5, if_missing=5))
+
+retire_many_schema = fef.ForEach(MessageId())
+
+retry_many_schema = fes.Schema(
+    messages=fef.ForEach(MessageId()),
+    delay=fev.Int(if_empty=5, if_missing=5))
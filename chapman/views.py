@@ -1,3 +1,4 @@
+import json
 import logging
 from datetime import datetime, timedelta
 
@@ -11,6 +12,7 @@ from formencode.variabledecode import variable_decode
 
 from chapman import model as M
 from chapman import validators as V
+from chapman.scheduler import DelayScheduler
 
 log = logging.getLogger(__name__)
 
@@ -23,7 +25,7 @@ def put(request):
     params = variable_decode(request.GET)
     metadata = V.message_schema.to_python(params, request)
     data = request.json
-    after = datetime.utcnow() + timedelta(metadata['delay'])
+    after = datetime.utcnow() + timedelta(seconds=metadata['delay'])
     msg = M.HTTPMessage.new(
         data=data,
         tags=metadata['tags'],
@@ -34,6 +36,45 @@ def put(request):
     request.response.status_int = 201
     return msg.url(request)
 
+
+@view_config(
+    route_name='chapman.1_0.queue',
+    request_method='POST',
+    request_param='batch',
+    renderer='json')
+@view_config(
+    route_name='chapman.1_0.queue',
+    request_method='POST',
+    header='Content-Type:application/x-ndjson',
+    renderer='json')
+def put_many(request):
+    '''Enqueue a JSON array (with ?batch=1) or a newline-delimited JSON
+    stream of messages, all with the same metadata'''
+    params = variable_decode(request.GET)
+    params.pop('batch', None)
+    metadata = V.message_schema.to_python(params, request)
+    try:
+        if request.content_type == 'application/x-ndjson':
+            datas = [
+                json.loads(line) for line in request.body.splitlines()
+                if line.strip()]
+        else:
+            datas = request.json
+    except ValueError:
+        raise exc.HTTPBadRequest('Invalid JSON')
+    if not isinstance(datas, list):
+        raise exc.HTTPBadRequest('Expected a JSON array of messages')
+    after = datetime.utcnow() + timedelta(seconds=metadata['delay'])
+    msgs = M.HTTPMessage.new_many(
+        datas,
+        tags=metadata['tags'],
+        timeout=metadata['timeout'],
+        after=after,
+        q=request.matchdict['qname'],
+        pri=metadata['priority'])
+    request.response.status_int = 201
+    return [msg.url(request) for msg in msgs]
+
 @view_config(
     route_name='chapman.1_0.queue',
     request_method='GET')
@@ -53,6 +94,29 @@ def get(request):
         return exc.HTTPNoContent()
 
 
+@view_config(
+    route_name='chapman.1_0.queue',
+    request_method='DELETE')
+def delete_messages(request):
+    '''Retires a JSON list of messages (ids or URLs) from the queue'''
+    ids = V.retire_many_schema.to_python(request.json, request)
+    M.HTTPMessage.retire_many(ids, request.matchdict['qname'])
+    return exc.HTTPNoContent()
+
+
+@view_config(
+    route_name='chapman.1_0.queue',
+    request_method='POST',
+    request_param='retry')
+def retry_messages(request):
+    '''Unlocks and retries {"messages": [...], "delay": seconds}'''
+    data = V.retry_many_schema.to_python(request.json, request)
+    after = datetime.utcnow() + timedelta(seconds=data['delay'])
+    M.HTTPMessage.retry_many(
+        data['messages'], after, request.matchdict['qname'])
+    return exc.HTTPNoContent()
+
+
 @view_config(
     route_name='chapman.1_0.message',
     request_method='DELETE')
@@ -68,11 +132,7 @@ def retry_message(request):
     '''Unlocks and retries the message at a point in the future'''
     data = V.retry_schema.to_python(request.json, request)
     after = datetime.utcnow() + timedelta(seconds=data['delay'])
-    M.HTTPMessage.m.update_partial(
-        dict(_id=int(request.matchdict['message_id'])),
-        {'s.status': 'ready',
-         's.after': after})
-    M.HTTPMessage.channel.pub('enqueue', int(request.matchdict['message_id']))
+    M.HTTPMessage.retry(int(request.matchdict['message_id']), after)
     return exc.HTTPNoContent()
 
 
@@ -105,6 +165,8 @@ def on_notfound(context, request):
 
 class MessageGetter(object):
     _registry = {}
+    _scheduler = None
+    max_batch = 1000  # messages to reserve per pass over the requests
 
     def __init__(self, qname, sleep):
         self.qname = qname
@@ -115,6 +177,13 @@ class MessageGetter(object):
 
     @classmethod
     def get(cls, qname, sleep, client, timeout, count):
+        if cls._scheduler is None:
+            # Promote delayed messages from this process, too
+            cls._scheduler = DelayScheduler(
+                M.HTTPMessage, event=gevent.event.Event(),
+                sleep=gevent.sleep)
+            gevent.spawn(cls._scheduler.run)
+            gevent.spawn(cls._scheduler.listen)
         getter = cls._registry.get(qname, None)
         if getter is None:
             getter = cls._registry[qname] = cls(qname, sleep)
@@ -132,38 +201,66 @@ class MessageGetter(object):
 
     def _gl_handler(self):
         while True:
-            # Get request
-            (exp, count, client, messages, event) = self.q.get()
+            # Wait for a request, then take all the others that are waiting
+            # (earliest expiring first)
+            requests = [self.q.get()]
+            while not self.q.empty():
+                requests.append(self.q.get_nowait())
             try:
-                # If request is expired, signal it and move on
-                if exp < datetime.utcnow():
-                    event.set()
-                    continue
-
-                # Get all the ready messages, up to the number requested
-                for x in range(count):
-                    msg = M.HTTPMessage.reserve(client, [self.qname])
-                    if msg is None:
-                        break
-                    messages.append(msg)
-                    # Only get 1 message if there are other requests waiting
-                    if not self.q.empty():
-                        break
-
-                # Found messages, notify caller and get next request
-                if messages or exp < datetime.utcnow():
-                    event.set()
-                    continue
-
-                # No messages, so we must put the request back onto the queue
-                # and wait for a channel event
-                self.q.put((exp, count, client, messages, event))
-
-                ev = M.Message.channel.await()
-                if ev is None:
-                    gevent.sleep(self.sleep / 1e3)
+                # If a request is expired, signal it and forget it
+                now = datetime.utcnow()
+                waiting = []
+                for req in requests:
+                    if req[0] < now:
+                        req[4].set()
+                    else:
+                        waiting.append(req)
+
+                found = self._fill(waiting)
+
+                # Notify the callers that got messages; put the others back
+                # onto the queue
+                now = datetime.utcnow()
+                for req in waiting:
+                    (exp, count, client, messages, event) = req
+                    if messages or exp < now:
+                        event.set()
+                    else:
+                        self.q.put(req)
+
+                # No messages at all, so wait for a channel event
+                if waiting and not found:
+                    ev = M.Message.channel.await()
+                    if ev is None:
+                        gevent.sleep(self.sleep / 1e3)
 
             except:
                 log.exception('Error in handler greenlet')
-                event.set()
+                for req in requests:
+                    req[4].set()
+
+    def _fill(self, requests):
+        '''Reserve messages for the waiting requests, returning how many
+        were found.
+
+        Each request gets an equal share of up to max_batch messages,
+        reserved with one reserve_many, so a lone request for many messages
+        is filled at once while many clients still get some each.
+        '''
+        if not requests:
+            return 0
+        share = max(1, self.max_batch // len(requests))
+        found = 0
+        for (exp, count, client, messages, event) in requests:
+            want = min(count - len(messages), share)
+            if want <= 0:
+                continue
+            reserved = M.HTTPMessage.reserve_many(client, [self.qname], want)
+            messages.extend(reserved)
+            found += len(reserved)
+            if len(reserved) < want:
+                # reserve_many retries lost races, so this means the queue
+                # is empty (not that somebody else got there first)
+                break
+        return found
 
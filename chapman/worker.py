@@ -6,10 +6,16 @@ import time
 import logging
 import threading
 from Queue import Queue, Empty
+from collections import defaultdict
 
 from pyramid.request import Request
+from pyramid.threadlocal import manager
 
 import model as M
+from .context import g
+from .util import sem_multi_acquire, sem_multi_release
+from .scheduler import DelayScheduler
+from .stats import stats
 from .task import Task, Function
 
 log = logging.getLogger(__name__)
@@ -21,7 +27,8 @@ class Worker(object):
     def __init__(
             self, app, name, qnames,
             chapman_path, registry,
-            num_threads=1, sleep=0.2, raise_errors=False):
+            num_threads=1, sleep=0.2, raise_errors=False, pool=None,
+            direct=False):
         self._app = app
         self._name = name
         self._qnames = qnames
@@ -29,10 +36,14 @@ class Worker(object):
         self._registry = registry
         self._num_threads = num_threads
         self._sleep = sleep
+        self._direct = direct
         Function.raise_errors = raise_errors
+        Function.pool = pool
         self._handler_threads = []
         self._num_active_messages = 0
         self._send_event = threading.Event()
+        self._scheduler = DelayScheduler(M.Message, counters=M.counters)
+        self._stats = defaultdict(int)
         self._shutdown = False  # flag to indicate worker is shutting down
 
     def start(self):
@@ -50,6 +61,8 @@ class Worker(object):
                 target=self.worker,
                 args=(sem, q))
             for x in range(self._num_threads)]
+        self._handler_threads.append(threading.Thread(
+            name='scheduler', target=self._scheduler.run))
         for t in self._handler_threads:
             t.setDaemon(True)
             t.start()
@@ -66,6 +79,8 @@ class Worker(object):
             data = msg['data']
             if data['worker'] in (self._name, '*'):
                 data['worker'] = self._name
+                data['stats'] = dict(self._stats)
+                data['latency'] = stats.snapshot()
                 chan.pub('pong', data)
 
         @chan.sub('kill')
@@ -79,46 +94,83 @@ class Worker(object):
             if msg['data'] in (self._name, '*'):
                 log.error('Received %r, shutting down gracefully', msg)
                 self._shutdown = True
+                self._scheduler.stop()
                 raise StopIteration()
 
+        @chan.sub('semaphore')
+        def handle_semaphore(chan, msg):
+            data = msg['data']
+            M.Semaphore.cache.set(data['_id'], data['value'])
+
+        @chan.sub('delay')
+        def handle_delay(chan, msg):
+            self._scheduler.notify(msg['data'])
+
         @chan.sub('send')
         def handle_send(chan, msg):
-            self._send_event.set()
+            self._handle_send(msg['data'])
 
         while True:
             try:
-                chan.handle_ready(await=True, raise_errors=True)
+                self._handle_events(chan)
             except StopIteration:
                 break
-            time.sleep(self._sleep)
 
         for t in self._handler_threads:
             t.join()
 
+    def _handle_events(self, chan):
+        '''Handle the events that are ready on chan'''
+        start = time.time()
+        chan.handle_ready(await=True, raise_errors=True)
+        # The tailable cursor normally blocks waiting for events, so only
+        # sleep if it returned early (to avoid spinning)
+        elapsed = time.time() - start
+        if elapsed < self._sleep:
+            time.sleep(self._sleep - elapsed)
+
+    def _handle_send(self, data):
+        '''Wake the dispatcher, unless the 'send' is for a queue we don't
+        serve'''
+        self._stats['send_events'] += 1
+        if isinstance(data, dict) and data.get('q', None) is not None:
+            if data['q'] not in self._qnames:
+                self._stats['send_ignored'] += 1
+                return
+        self._send_event.set()
+
     def _waitfunc(self):
+        '''Wait for a 'send' event, returning True if one arrived'''
         if self._shutdown:
             raise StopIteration()
+        # Clear *after* waking so a 'send' that arrives while we are
+        # reserving wakes us immediately rather than being lost
+        woken = self._send_event.wait(self._sleep)
         self._send_event.clear()
-        self._send_event.wait(self._sleep)
+        return woken
 
     def dispatcher(self, sem, q):
         log.info('Entering dispatcher thread')
         while not self._shutdown:
-            sem.acquire()
+            count = sem_multi_acquire(sem, self._num_threads)
             try:
-                msg, state = _reserve_msg(
-                    self._name, self._qnames, self._waitfunc)
+                reserved = _reserve_msgs(
+                    self._name, self._qnames, count, self._waitfunc,
+                    self._stats)
             except StopIteration:
                 break
             except Exception as err:
                 exc_log.exception(
                     'Error reserving message: %r, waiting 5s and continuing',
                     err)
-                sem.release()
+                sem_multi_release(sem, count)
                 time.sleep(5)
                 continue
-            self._num_active_messages += 1
-            q.put((msg, state))
+            # sem.release() for each slot we could NOT fill
+            sem_multi_release(sem, count - len(reserved))
+            for msg, state in reserved:
+                self._num_active_messages += 1
+                q.put((msg, state))
         log.info('Exiting dispatcher thread')
 
     def worker(self, sem, q):
@@ -129,26 +181,59 @@ class Worker(object):
             except Empty:
                 continue
             try:
-                log.info('Received %r', msg)
-                task = Task.from_state(state)
-                # task.handle(msg, 25)
-                if task.path:
-                    req = Request.blank(task.path, method='CHAPMAN')
-                else:
-                    req = Request.blank(self._chapman_path, method='CHAPMAN')
-                req.registry = self._registry
-                req.environ['chapmand.task'] = task
-                req.environ['chapmand.message'] = msg
-                for x in self._app(req.environ, lambda *a,**kw:None):
-                    pass
-            except Exception as err:
-                exc_log.exception('Unexpected error in worker thread: %r', err)
-                time.sleep(self._sleep)
+                self._handle(msg, state)
             finally:
-                self._num_active_messages -= 1
                 sem.release()
         log.info('Exiting chapmand worker thread')
 
+    def _handle(self, msg, state):
+        '''Run a reserved message, directly or through the chapman view'''
+        try:
+            log.info('Received %r', msg)
+            task = Task.from_state(state)
+            if self._can_handle_direct(task):
+                self._handle_direct(task, msg)
+            else:
+                self._handle_wsgi(task, msg)
+        except Exception as err:
+            exc_log.exception('Unexpected error in worker thread: %r', err)
+            time.sleep(self._sleep)
+        finally:
+            self._num_active_messages -= 1
+
+    def _can_handle_direct(self, task):
+        '''Tasks with their own path need that path's view, so only the ones
+        for chapman_path can skip the WSGI app'''
+        if not self._direct or task.use_wsgi:
+            return False
+        return not task.path or task.path == self._chapman_path
+
+    def _handle_wsgi(self, task, msg):
+        if task.path:
+            req = Request.blank(task.path, method='CHAPMAN')
+        else:
+            req = Request.blank(self._chapman_path, method='CHAPMAN')
+        req.registry = self._registry
+        req.environ['chapmand.task'] = task
+        req.environ['chapmand.message'] = msg
+        for x in self._app(req.environ, lambda *a,**kw:None):
+            pass
+
+    def _handle_direct(self, task, msg):
+        '''Call task.handle with the same context chapmand.handle_task
+        would provide, but without running the WSGI app for every message.
+        Each message still gets a fresh request, so nothing one task sets on
+        g.request leaks into the next.
+        '''
+        req = Request.blank(self._chapman_path, method='CHAPMAN')
+        req.registry = self._registry
+        manager.push(dict(request=req, registry=self._registry))
+        try:
+            with g.set_context(request=req, registry=self._registry):
+                task.handle(msg)
+        finally:
+            manager.pop()
+
     def handle_messages(self):
         '''Handle messages until there are no more'''
         while True:
@@ -159,12 +244,16 @@ class Worker(object):
             task.handle(msg)
 
 
-def _reserve_msg(name, qnames, waitfunc):
+def _reserve_msgs(name, qnames, count, waitfunc, stats):
+    woken = False
     while True:
-        msg, state = M.Message.reserve(name, qnames)
-        if msg is None:
-            waitfunc()
+        reserved = M.Message.reserve_many(name, qnames, count)
+        if not reserved:
+            if woken:  # somebody else got the message
+                stats['wasted_wakeups'] += 1
+            woken = waitfunc()
             continue
-        if state is None:
+        reserved = [(msg, state) for msg, state in reserved if state]
+        if not reserved:
             continue
-        return msg, state
+        return reserved
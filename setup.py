@@ -25,6 +25,7 @@ setup(name='Chapman',
           'scripts/chapman-ping',
           'scripts/chapman-kill',
           'scripts/chapman-unlock',
+          'scripts/chapman-gc',
       ],
       install_requires=[
           # -*- Extra requirements: -*-
@@ -41,5 +42,6 @@ setup(name='Chapman',
       [console_scripts]
       chapman-hq-ping = chapman.script:hq_ping
       chapmand = chapman.script:Chapman.script
+      chapman-bench = chapman.bench:main
       """,
       )